@@ -0,0 +1,19 @@
+import argparse
+
+from utils.datasets import *
+from utils.parse_config import parse_data_cfg
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data', type=str, default='data/FLIR.data', help='*.data path')
+    parser.add_argument('--list', nargs='*', default=[], help='image list *.txt paths (default: train and valid)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of checking processes')
+    opt = parser.parse_args()
+    print(opt)
+
+    # Writes a <list>.report next to each image list, flagged entries are then skipped by LoadImagesAndLabels
+    if not opt.list:
+        data = parse_data_cfg(opt.data)
+        opt.list = [data['train'], data['valid']]
+    for path in opt.list:
+        check_dataset(path, opt.workers)
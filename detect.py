@@ -9,7 +9,7 @@ from utils.utils import *
 def detect(save_img=False):
     img_size = (320, 192) if ONNX_EXPORT else opt.img_size  # (320, 192) or (416, 256) or (608, 352) for (height, width)
     out, source, weights, half, view_img, save_txt = opt.output, opt.source, opt.weights, opt.half, opt.view_img, opt.save_txt
-    webcam = source == '0' or source.startswith('rtsp') or source.startswith('http') or source.endswith('.txt')
+    webcam = source == '0' or source.startswith(('rtsp', 'http', 'shm://')) or source.endswith('.txt')
 
     # Initialize
     device = torch_utils.select_device(device='cpu' if ONNX_EXPORT else opt.device)
@@ -23,7 +23,7 @@ def detect(save_img=False):
     # Load weights
     attempt_download(weights)
     if weights.endswith('.pt'):  # pytorch format
-        model.load_state_dict(torch.load(weights, map_location=device)['model'])
+        model.load_state_dict(fold_channels(torch.load(weights, map_location=device)['model'], model))
     else:  # darknet format
         load_darknet_weights(model, weights)
 
@@ -44,7 +44,7 @@ def detect(save_img=False):
     # Export mode
     if ONNX_EXPORT:
         model.fuse()
-        img = torch.zeros((1, 3) + img_size)  # (1, 3, 320, 192)
+        img = torch.zeros((1, model.channels) + img_size)  # (1, 3, 320, 192)
         torch.onnx.export(model, img, 'weights/export.onnx', verbose=False, opset_version=10)
 
         # Validate exported model
@@ -64,48 +64,58 @@ def detect(save_img=False):
     if webcam:
         view_img = True
         torch.backends.cudnn.benchmark = True  # set True to speed up constant image size inference
-        dataset = LoadStreams(source, img_size=img_size, half=half)
+        loader = LoadFrameRing if opt.decode_procs or source.startswith('shm://') else LoadStreams
+        dataset = loader(source, img_size=img_size, half=half, channels=model.channels, decimate=opt.decimate)
     else:
         save_img = True
-        dataset = LoadImages(source, img_size=img_size, half=half)
+        dataset = LoadImages(source, img_size=img_size, half=half, channels=model.channels, reduce=opt.reduce)
 
     # Get names and colors
     names = load_classes(opt.names)
     colors = [[random.randint(0, 255) for _ in range(3)] for _ in range(len(names))]
 
-    # Run inference
-    t0 = time.time()
-    for path, img, im0s, vid_cap in dataset:
+    # Batches of paths, images, im0s, video (fps, w, h) or None, info strings, original hw
+    if webcam:  # one frame per stream
+        batches = ((path, img, im0s, [None] * len(im0s), ['%g: ' % i for i in range(len(im0s))],
+                    [x.shape[:2] for x in im0s]) for path, img, im0s, _ in dataset)
+    else:  # consecutive images of equal letterboxed shape, or frames of one video
+        batches = batch_images(dataset, opt.batch_size)
+
+    # Pipeline stages, each in its own thread: decode (batches) -> infer -> draw -> write (on this thread, for HighGUI)
+    def infer(batch):
+        path, img, im0s, videos, infos, hw0s = batch
         t = time.time()
+        with torch.no_grad():  # grad mode is per thread
+            # Get detections
+            img = torch.from_numpy(img).to(device)
+            pred = model(img)[0]
 
-        # Get detections
-        img = torch.from_numpy(img).to(device)
-        if img.ndimension() == 3:
-            img = img.unsqueeze(0)
-        pred = model(img)[0]
+            if opt.half:
+                pred = pred.float()
 
-        if opt.half:
-            pred = pred.float()
+            # Apply NMS
+            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes,
+                                       agnostic=opt.agnostic_nms)
 
-        # Apply NMS
-        pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+            # Apply Classifier
+            if classify:
+                pred = apply_classifier(pred, modelc, img, im0s)
+        yield path, img.shape[2:], pred, im0s, videos, infos, hw0s, time.time() - t
 
-        # Apply Classifier
-        if classify:
-            pred = apply_classifier(pred, modelc, img, im0s)
+    def draw(batch):
+        path, shape, pred, im0s, videos, infos, hw0s, dt = batch
 
         # Process detections
         for i, det in enumerate(pred):  # detections per image
-            if webcam:  # batch_size >= 1
-                p, s, im0 = path[i], '%g: ' % i, im0s[i]
-            else:
-                p, s, im0 = path, '', im0s
+            p, s, im0, video = path[i], infos[i], im0s[i], videos[i]
 
             save_path = str(Path(out) / Path(p).name)
-            s += '%gx%g ' % img.shape[2:]  # print string
+            if im0.ndim == 2 and (save_img or view_img):  # grayscale source, draw colored boxes
+                im0 = cv2.cvtColor(im0, cv2.COLOR_GRAY2BGR)
+            s += '%gx%g ' % shape  # print string
             if det is not None and len(det):
                 # Rescale boxes from img_size to im0 size
-                det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+                det[:, :4] = scale_coords(shape, det[:, :4], im0.shape).round()
 
                 # Print results
                 for c in det[:, -1].unique():
@@ -113,39 +123,63 @@ def detect(save_img=False):
                     s += '%g %ss, ' % (n, names[int(c)])  # add to string
 
                 # Write results
-                for *xyxy, conf, cls in det:
-                    if save_txt:  # Write to file
-                        with open(save_path + '.txt', 'a') as file:
-                            file.write(('%g ' * 6 + '\n') % (*xyxy, cls, conf))
-
-                    if save_img or view_img:  # Add bbox to image
+                if save_img or view_img:  # Add bbox to image
+                    for *xyxy, conf, cls in det:
                         label = '%s %.2f' % (names[int(cls)], conf)
                         plot_one_box(xyxy, im0, label=label, color=colors[int(cls)])
+            if save_txt:  # Buffer results, in original image pixels if im0 was decoded reduced (--reduce)
+                (h0, w0), (h, w) = hw0s[i], im0.shape[:2]
+                if det is not None and len(det) and (h0, w0) != (h, w):
+                    det = det.clone()
+                    det[:, [0, 2]] *= w0 / w
+                    det[:, [1, 3]] *= h0 / h
+                writer.add(save_path, det)
 
             # Print time (inference + NMS)
-            print('%sDone. (%.3fs)' % (s, time.time() - t))
-
-            # Stream results
-            if view_img:
-                cv2.imshow(p, im0)
-                if cv2.waitKey(1) == ord('q'):  # q to quit
-                    raise StopIteration
-
-            # Save results (image with detections)
-            if save_img:
-                if dataset.mode == 'images':
-                    cv2.imwrite(save_path, im0)
-                else:
-                    if vid_path != save_path:  # new video
-                        vid_path = save_path
-                        if isinstance(vid_writer, cv2.VideoWriter):
-                            vid_writer.release()  # release previous video writer
-
-                        fps = vid_cap.get(cv2.CAP_PROP_FPS)
-                        w = int(vid_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-                        h = int(vid_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-                        vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*opt.fourcc), fps, (w, h))
-                    vid_writer.write(im0)
+            print('%sDone. (%.3fs)' % (s, dt))
+            yield p, save_path, im0, video
+
+    def write(x):
+        nonlocal vid_path, vid_writer, save_path
+        p, save_path, im0, video = x
+
+        # Stream results
+        if view_img:
+            cv2.imshow(p, im0)
+            if cv2.waitKey(1) == ord('q'):  # q to quit
+                cv2.destroyAllWindows()
+                raise StopIteration
+
+        # Save results (image with detections)
+        if save_img:
+            if video is None:
+                cv2.imwrite(save_path, im0)
+            else:
+                if vid_path != save_path:  # new video
+                    vid_path = save_path
+                    if isinstance(vid_writer, cv2.VideoWriter):
+                        vid_writer.release()  # release previous video writer
+
+                    fps, w, h = video
+                    vid_writer = cv2.VideoWriter(save_path, cv2.VideoWriter_fourcc(*opt.fourcc), fps, (w, h))
+                vid_writer.write(im0)
+        return ()
+
+    # Run inference
+    t0 = time.time()
+    save_path = out
+    writer = DetectionWriter(out, opt.save_format) if save_txt else None
+    try:  # Ctrl-C normally ends stream runs, buffered detections and videos are still saved
+        stats = pipeline(('decode', batches), [('infer', infer), ('draw', draw), ('write', write)],
+                         maxsize=opt.queue_size)
+    finally:
+        if isinstance(vid_writer, cv2.VideoWriter):
+            vid_writer.release()
+        if writer is not None:
+            writer.close()
+    print_pipeline_stats(stats)
+    if webcam:
+        print(dataset.info())
 
     if save_txt or save_img:
         print('Results saved to %s' % os.getcwd() + os.sep + out)
@@ -167,9 +201,15 @@ if __name__ == '__main__':
     parser.add_argument('--iou-thres', type=float, default=0.5, help='IOU threshold for NMS')
     parser.add_argument('--fourcc', type=str, default='mp4v', help='output video codec (verify ffmpeg support)')
     parser.add_argument('--half', action='store_true', help='half precision FP16 inference')
+    parser.add_argument('--batch-size', type=int, default=1, help='images or video frames per inference batch')
+    parser.add_argument('--decimate', type=int, default=4, help='use every n-th frame of streams')
+    parser.add_argument('--decode-procs', action='store_true', help='decode streams in processes into shared memory')
+    parser.add_argument('--queue-size', type=int, default=4, help='items queued between pipeline stages')
+    parser.add_argument('--reduce', action='store_true', help='decode large JPEGs at 1/2-1/8 scale (reduced outputs)')
     parser.add_argument('--device', default='', help='device id (i.e. 0 or 0,1) or cpu')
     parser.add_argument('--view-img', action='store_true', help='display results')
     parser.add_argument('--save-txt', action='store_true', help='save results to *.txt')
+    parser.add_argument('--save-format', default='txt', choices=DetectionWriter.formats, help='--save-txt format')
     parser.add_argument('--classes', nargs='+', type=int, help='filter by class')
     parser.add_argument('--agnostic-nms', action='store_true', help='class-agnostic NMS')
     opt = parser.parse_args()
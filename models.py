@@ -218,6 +218,7 @@ class Darknet(nn.Module):
         super(Darknet, self).__init__()
 
         self.module_defs = parse_model_cfg(cfg)
+        self.channels = int(self.module_defs[0]['channels'])  # input channels, 1 for native grayscale input
         self.module_list, self.routs = create_modules(self.module_defs, img_size, arc)
         self.yolo_layers = get_yolo_layers(self)
 
@@ -307,8 +308,9 @@ def create_grids(self, img_size=640, ng=(13, 13), device='cpu', type=torch.float
     self.ny = ny
 
 
-def load_darknet_weights(self, weights, cutoff=-1):
-    # Parses and loads the weights stored in 'weights'
+def load_darknet_weights(self, weights, cutoff=-1, fold=None):
+    # Parses and loads the weights stored in 'weights'. fold sums 3-channel (RGB) first-layer weights into a 1-channel
+    # model, None to fold only if the file holds exactly the extra RGB weights
 
     # Establish cutoffs (load layers between 0 and cutoff. if cutoff = -1 all are loaded)
     file = Path(weights).name
@@ -325,6 +327,13 @@ def load_darknet_weights(self, weights, cutoff=-1):
 
         weights = np.fromfile(f, dtype=np.float32)  # the rest are weights
 
+    # Fold 3-channel first-layer weights into a 1-channel (grayscale) model, detected from the extra weight count
+    # unless given (files with more weights than the model, i.e. COCO weights with more classes, need fold=True)
+    conv0 = self.module_list[0][0]
+    if fold is None:
+        fold = weights.size - n_darknet_weights(self, cutoff) == 2 * conv0.weight.numel()
+    fold = fold and conv0.in_channels == 1
+
     ptr = 0
     for i, (mdef, module) in enumerate(zip(self.module_defs[:cutoff], self.module_list[:cutoff])):
         if mdef['type'] == 'convolutional':
@@ -357,10 +366,37 @@ def load_darknet_weights(self, weights, cutoff=-1):
                 ptr += num_b
             # Load conv. weights
             num_w = conv_layer.weight.numel()
-            conv_w = torch.from_numpy(weights[ptr:ptr + num_w]).view_as(conv_layer.weight)
+            if fold and i == 0:  # sum over RGB, exact for grayscale replicated to 3 channels
+                conv_w = torch.from_numpy(weights[ptr:ptr + num_w * 3]).view(conv_layer.out_channels, 3, -1)
+                conv_w = conv_w.sum(1, keepdim=True).view_as(conv_layer.weight)
+                ptr += num_w * 2
+            else:
+                conv_w = torch.from_numpy(weights[ptr:ptr + num_w]).view_as(conv_layer.weight)
             conv_layer.weight.data.copy_(conv_w)
             ptr += num_w
 
+    if ptr != weights.size:
+        print('WARNING: %d of the %d weights in %s loaded%s, layers after the first one that differs from the cfg '
+              'are misaligned' % (ptr, weights.size, file, ' (RGB folded to 1 channel)' if fold else
+                                  ' (use --fold-rgb for RGB weights)' if conv0.in_channels == 1 else ''))
+
+
+def n_darknet_weights(self, cutoff=-1):
+    # Returns the number of darknet weights of model self up to cutoff
+    return sum((4 * module[1].bias.numel() if mdef['batch_normalize'] else module[0].bias.numel()) +
+               module[0].weight.numel() for mdef, module in zip(self.module_defs[:cutoff], self.module_list[:cutoff])
+               if mdef['type'] == 'convolutional')
+
+
+def fold_channels(state_dict, model):
+    # Sums 3-channel input-layer weights of a *.pt state_dict over their input channels to fit a 1-channel model
+    # (exact for grayscale input: conv(gray replicated to 3 channels, w) == conv(gray, w.sum(1)))
+    msd = model.state_dict()
+    for k, v in state_dict.items():
+        if k in msd and v.dim() == 4 and v.shape[1] == 3 and msd[k].shape[1] == 1 and v.shape[0] == msd[k].shape[0]:
+            state_dict[k] = v.sum(1, keepdim=True)
+    return state_dict
+
 
 def save_weights(self, path='model.weights', cutoff=-1):
     # Converts a PyTorch model to Darket format (*.pt to *.weights)
@@ -397,7 +433,7 @@ def convert(cfg='cfg/yolov3-spp.cfg', weights='weights/yolov3-spp.weights'):
 
     # Load weights and save
     if weights.endswith('.pt'):  # if PyTorch format
-        model.load_state_dict(torch.load(weights, map_location='cpu')['model'])
+        model.load_state_dict(fold_channels(torch.load(weights, map_location='cpu')['model'], model))
         save_weights(model, path='converted.weights', cutoff=-1)
         print("Success: converted '%s' to 'converted.weights'" % weights)
 
@@ -20,7 +20,9 @@ def test(cfg,
          single_cls=False,
          model=None,
          dataloader=None,
-         experiment_name='Test'):
+         experiment_name='Test',
+         workers=None,
+         autotune=False):
     # Initilize Experiment Name
     experiment_name = "JSON/" + experiment_name + str(numCount)
 
@@ -40,12 +42,13 @@ def test(cfg,
         # Load weights
         attempt_download(weights)
         if weights.endswith('.pt'):  # pytorch format
-            model.load_state_dict(torch.load(weights, map_location=device)['model'])
+            model.load_state_dict(fold_channels(torch.load(weights, map_location=device)['model'], model))
         else:  # darknet format
             load_darknet_weights(model, weights)
 
         if torch.cuda.device_count() > 1:
             model = nn.DataParallel(model)
+            model.channels = model.module.channels
     else:  # called by train.py
         device = next(model.parameters()).device  # get model device
         verbose = False
@@ -61,13 +64,23 @@ def test(cfg,
 
     # Dataloader
     if dataloader is None:
-        dataset = LoadImagesAndLabels(path, img_size, batch_size, rect=False)
-        batch_size = min(batch_size, len(dataset))
-        dataloader = DataLoader(dataset,
-                                batch_size=batch_size,
-                                num_workers=min([os.cpu_count(), batch_size if batch_size > 1 else 0, 8]),
-                                pin_memory=True,
-                                collate_fn=dataset.collate_fn)
+        if path.endswith('.shards'):  # packed shards, see create_shards()
+            dataset = LoadShards(path, img_size, batch_size, channels=model.channels)
+        else:
+            dataset = LoadImagesAndLabels(path, img_size, batch_size, rect=False, channels=model.channels)
+        batch_size = min(batch_size, dataset.n)
+        nw = min([os.cpu_count(), batch_size if batch_size > 1 else 0, 8]) if workers is None else workers
+        pf = 2  # batches prefetched per worker
+        if autotune:
+            nw, pf = autotune_dataloader(dataset, batch_size, path)
+        if isinstance(dataset, LoadShards):
+            dataloader = shard_loader(dataset, batch_size, **loader_kwargs(nw, pf), pin_memory=True)
+        else:
+            dataloader = DataLoader(dataset,
+                                    batch_size=batch_size,
+                                    **loader_kwargs(nw, pf),
+                                    pin_memory=True,
+                                    collate_fn=dataset.collate_fn)
 
     seen = 0
     model.eval()
@@ -233,6 +246,8 @@ if __name__ == '__main__':
     parser.add_argument('--device', default='', help='device id (i.e. 0 or 0,1) or cpu')
     parser.add_argument('--single-cls', action='store_true', help='train as single-class dataset')
     parser.add_argument("--experiment-name", type=str, default='Atlas', help='Experiment Name')
+    parser.add_argument('--workers', type=int, help='dataloader workers (default min(cpus, batch-size, 8))')
+    parser.add_argument('--autotune', action='store_true', help='calibrate dataloader workers and prefetch (cached)')
     opt = parser.parse_args()
     opt.save_json = opt.save_json or any([x in opt.data for x in ['coco.data', 'coco2014.data', 'coco2017.data']])
     print(opt)
@@ -248,7 +263,9 @@ if __name__ == '__main__':
              opt.conf_thres,
              opt.iou_thres,
              opt.save_json,
-             opt.single_cls)
+             opt.single_cls,
+             workers=opt.workers,
+             autotune=opt.autotune)
 
     elif opt.task == 'benchmark':
         # mAPs at 320-608 at conf 0.5 and 0.7
@@ -19,6 +19,7 @@ wdir = 'weights' + os.sep  # weights dir
 last = wdir + 'last.pt'
 best = wdir + 'best.pt'
 results_file = 'results.txt'
+timing_file = 'timing.txt'  # per-epoch loading stage times with --timing
 
 # Hyperparameters (results68: 59.9 mAP@0.5 yolov3-spp-416) https://github.com/ultralytics/yolov3/issues/310
 
@@ -76,7 +77,7 @@ def train():
     nc = 1 if opt.single_cls else int(data_dict['classes'])  # number of classes
     print("Total Number of clases:", nc)
     # Remove previous results
-    for f in glob.glob('*_batch*.jpg') + glob.glob(results_file):
+    for f in glob.glob('*_batch*.jpg') + glob.glob(results_file) + glob.glob(timing_file):
         os.remove(f)
 
     # Initialize model
@@ -114,6 +115,7 @@ def train():
 
         # load model
         try:
+            chkpt['model'] = fold_channels(chkpt['model'], model)  # 3-channel checkpoints into 1-channel models
             chkpt['model'] = {k: v for k, v in chkpt['model'].items() if model.state_dict()[k].numel() == v.numel()}
             model.load_state_dict(chkpt['model'], strict=False)
         except KeyError as e:
@@ -136,7 +138,7 @@ def train():
 
     elif len(weights) > 0:  # darknet format
         # possible weights are '*.weights', 'yolov3-tiny.conv.15',  'darknet53.conv.74' etc.
-        load_darknet_weights(model, weights)
+        load_darknet_weights(model, weights, fold=opt.fold_rgb or None)
 
     # Scheduler https://github.com/ultralytics/yolov3/issues/238
     # lf = lambda x: 1 - x / epochs  # linear ramp to zero
@@ -173,42 +175,96 @@ def train():
                                 rank=0)  # distributed training node rank
         model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
         model.yolo_layers = model.module.yolo_layers  # move yolo layer indices to top level
+        model.channels = model.module.channels
 
     # Dataset
-    dataset = LoadImagesAndLabels(train_path, img_size, batch_size,
-                                  augment=True,
-                                  hyp=hyp,  # augmentation hyperparameters
-                                  rect=False,  # rectangular training
-                                  cache_labels=True,
-                                  cache_images=opt.cache_images,
-                                  single_cls=opt.single_cls)
+    batch_size_test = 32  # Correct Batch Size for Testing
+    cache_images = SharedImageCache() if opt.cache_images == 'shm' else opt.cache_images  # shared by train and test
+    if train_path.endswith('.shards'):  # packed shards, see create_shards()
+        dataset = LoadShards(train_path, img_size, batch_size,
+                             augment=True,
+                             hyp=hyp,  # augmentation hyperparameters
+                             single_cls=opt.single_cls,
+                             channels=model.channels,
+                             buffer_size=opt.shard_buffer)
+    else:
+        dataset = LoadImagesAndLabels(train_path, img_size, batch_size,
+                                      augment=True,
+                                      hyp=hyp,  # augmentation hyperparameters
+                                      rect=opt.rect,  # rectangular training
+                                      image_weights=opt.img_weights,  # sample images by class content
+                                      cache_labels=True,
+                                      cache_images=cache_images,
+                                      single_cls=opt.single_cls,
+                                      channels=model.channels,
+                                      cache_bytes=opt.cache_gb * 1E9)
+    if test_path.endswith('.shards'):
+        testset = LoadShards(test_path, img_size_test, batch_size_test,
+                             hyp=hyp,
+                             single_cls=opt.single_cls,
+                             channels=model.channels)
+    else:
+        testset = LoadImagesAndLabels(test_path, img_size_test, batch_size_test,
+                                      hyp=hyp,
+                                      rect=False,
+                                      cache_labels=True,
+                                      cache_images=False if cache_images == 'lru' else cache_images,  # few LRU hits
+                                      single_cls=opt.single_cls,
+                                      channels=model.channels,
+                                      cache_bytes=opt.cache_gb * 1E9)
 
     # Dataloader
-    batch_size = min(batch_size, len(dataset))
-    nw = 8  # number of workers
-    # Calculate Correct Batch Size for Testing
-    batch_size_test = 32
-
-
-    # Proceed to Create Dataloaders
-    dataloader = torch.utils.data.DataLoader(dataset,
-                                             batch_size=batch_size,
-                                             num_workers=nw,
-                                             shuffle=True,  # Shuffle=True unless rectangular training is used
-                                             pin_memory=True,
-                                             collate_fn=dataset.collate_fn)
-
-    # Testloader
-    testloader = torch.utils.data.DataLoader(LoadImagesAndLabels(test_path, img_size_test, batch_size_test,
-                                                                 hyp=hyp,
-                                                                 rect=False,
-                                                                 cache_labels=True,
-                                                                 cache_images=opt.cache_images,
-                                                                 single_cls=opt.single_cls),
-                                             batch_size=32,
-                                             num_workers=nw,
-                                             pin_memory=True,
-                                             collate_fn=dataset.collate_fn)
+    batch_size = min(batch_size, dataset.n)
+
+    if isinstance(cache_images, SharedImageCache):
+        cache_images.build()  # one segment for both datasets, before dataloader workers start
+    nw, pf = opt.workers, 2  # number of workers, batches prefetched per worker
+
+    # Proceed to Create Dataloaders, workers persist for the whole run
+    weighted_sampler = None
+    if getattr(dataset, 'rect', False):  # rectangular training, shuffled aspect ratio buckets
+        batch_sampler = AspectRatioBatchSampler(dataset, batch_size)
+    elif dataset.image_weights:  # weighted sampling with replacement, weights updated every epoch
+        batch_sampler = weighted_sampler = WeightedBatchSampler(torch.ones(dataset.n), batch_size)
+    elif not isinstance(dataset, IterableDataset):
+        batch_sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset), batch_size,
+                                                      drop_last=False)
+    if opt.autotune and not opt.augment_ahead:
+        nw, pf = autotune_dataloader(dataset, batch_size, train_path,
+                                     batch_sampler=None if isinstance(dataset, IterableDataset) else batch_sampler)
+    if opt.timing:  # after autotune, whose calibration samples are not timed
+        dataset.timer = StageTimer()  # shared with dataloader workers
+        with open(timing_file, 'a') as f:
+            f.write(('%10s' * (len(StageTimer.stages) + 1)) % ('Epoch', *StageTimer.stages) + '\n')
+    kwargs = dict(**loader_kwargs(nw, pf), pin_memory=True)
+    if isinstance(dataset, IterableDataset) or isinstance(testset, IterableDataset):  # no shared pool, one per loader
+        if isinstance(dataset, LoadShards):  # shards, iterated once per epoch
+            dataloader = shard_loader(dataset, batch_size, **kwargs)
+        elif not opt.augment_ahead:
+            dataloader = InfiniteDataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn,
+                                            **kwargs)
+        if isinstance(testset, LoadShards):
+            testloader = shard_loader(testset, batch_size_test, **kwargs)
+        else:
+            testloader = (torch.utils.data.DataLoader if opt.notest or opt.cache_val else InfiniteDataLoader)(
+                testset, batch_size=batch_size_test, collate_fn=testset.collate_fn, **kwargs)
+    elif opt.notest or opt.augment_ahead or opt.cache_val:  # test workers not needed every epoch, or no train loader
+        if not opt.augment_ahead:
+            dataloader = InfiniteDataLoader(dataset, batch_sampler=batch_sampler, collate_fn=dataset.collate_fn,
+                                            **kwargs)
+        testloader = (torch.utils.data.DataLoader if opt.notest or opt.cache_val else InfiniteDataLoader)(
+            testset, batch_size=batch_size_test, collate_fn=testset.collate_fn, **kwargs)
+    else:  # one worker pool for train and test batches
+        loaders = TrainTestLoaders(dataset, testset, batch_sampler, batch_size_test, **kwargs)
+        dataloader, testloader = loaders.train, loaders.test
+    if opt.cache_val:  # letterboxed test batches saved on the first test pass, streamed from disk afterwards
+        testloader = LetterboxCache(testloader, wdir)
+    if opt.augment_ahead:  # augmented batches produced ahead by background processes into a ring
+        dataloader = AugmentRing(dataset, batch_size,
+                                 slots=opt.ring_size,
+                                 workers=opt.augment_ahead,
+                                 reuse=opt.ring_reuse,
+                                 file=opt.ring_file)
 
     # Start training
     nb = len(dataloader)
@@ -219,6 +275,8 @@ def train():
     model.hyp = hyp  # attach hyperparameters to model
     model.class_weights = labels_to_class_weights(dataset.labels, nc).to(device)  # attach class weights
     maps = np.zeros(nc)  # mAP per class
+    if dataset.image_weights:
+        class_counts = labels_to_class_counts(dataset.labels, nc)  # (images, classes) label counts, computed once
     # torch.autograd.set_detect_anomaly(True)
     results = (0, 0, 0, 0, 0, 0, 0)  # 'P', 'R', 'mAP', 'F1', 'val GIoU', 'val Objectness', 'val Classification'
     t0 = time.time()
@@ -245,13 +303,16 @@ def train():
         # Update image weights (optional)
         if dataset.image_weights:
             w = model.class_weights.cpu().numpy() * (1 - maps) ** 2  # class weights
-            image_weights = labels_to_image_weights(dataset.labels, nc=nc, class_weights=w)
-            dataset.indices = random.choices(range(dataset.n), weights=image_weights, k=dataset.n)  # rand weighted idx
+            image_weights = labels_to_image_weights(class_counts, nc=nc, class_weights=w)
+            weighted_sampler.weights = torch.from_numpy(image_weights).double()  # read for every batch drawn
 
         mloss = torch.zeros(4).to(device)  # mean losses
         print(('\n' + '%10s' * 8) % ('Epoch', 'gpu_mem', 'GIoU', 'obj', 'cls', 'total', 'targets', 'img_size'))
         pbar = tqdm(enumerate(dataloader), total=nb)  # progress bar
+        t_epoch = time.time()
         for i, (imgs, targets, paths, _) in pbar:  # batch -------------------------------------------------------------
+            if i == 0:
+                t_first = time.time() - t_epoch  # dataloader startup latency
             ni = i + nb * epoch  # number integrated batches (since train start)
             imgs = imgs.to(device).float() / 255.0  # uint8 to float32, 0 - 255 to 0.0 - 1.0
             targets = targets.to(device)
@@ -313,7 +374,8 @@ def train():
             mem = torch.cuda.memory_cached() / 1E9 if torch.cuda.is_available() else 0  # (GB)
             s = ('%10s' * 2 + '%10.3g' * 6) % (
                 '%g/%g' % (epoch, epochs - 1), '%.3gG' % mem, *mloss, len(targets), img_size)
-            pbar.set_description(s)
+            pbar.set_description(s + (dataset.lru.info() if dataset.lru else '') +
+                                 (dataloader.info() if opt.augment_ahead else ''))
 
             # end batch ------------------------------------------------------------------------------------------------
 
@@ -334,10 +396,16 @@ def train():
 
         # Update scheduler
         scheduler.step()
+        print('First batch after %.2fs' % t_first)
 
         # Write epoch results
         with open(results_file, 'a') as f:
             f.write(s + '%10.3g' * 7 % results + '\n')  # P, R, mAP, F1, test_losses=(GIoU, obj, cls)
+        if dataset.timer is not None:  # loading stage ms per sample, same epoch as the results.txt line
+            times = dataset.timer.per_sample()
+            with open(timing_file, 'a') as f:
+                f.write(('%10s' + '%10.3g' * len(times)) % ('%g/%g' % (epoch, epochs - 1), *times.values()) + '\n')
+            print('Loading stages: ' + dataset.timer.info())
         if len(opt.name) and opt.bucket:
             os.system('gsutil cp results.txt gs://%s/results/results%s.txt' % (opt.bucket, opt.name))
 
@@ -348,6 +416,13 @@ def train():
                       'Precision', 'Recall', 'mAP', 'F1', 'val GIoU', 'val Objectness', 'val Classification']
             for xi, title in zip(x, titles):
                 tb_writer.add_scalar(title, xi, epoch)
+            tb_writer.add_scalar('First batch latency', t_first, epoch)
+            if dataset.timer is not None:
+                for k, t in dataset.timer.per_sample().items():
+                    tb_writer.add_scalar('Loading ms/%s' % k, t, epoch)
+
+        if dataset.timer is not None:
+            dataset.timer.reset()
 
         # Update best mAP
         fi = fitness(np.array(results).reshape(1, -1))  # fitness_i = weighted combination of [P, R, mAP, F1]
@@ -398,7 +473,8 @@ def train():
             os.system('gsutil cp %s gs://%s/weights' % (wdir + flast, opt.bucket))
             # os.system('gsutil cp %s gs://%s/weights' % (wdir + fbest, opt.bucket))
 
-    
+    if opt.cache_val:
+        testloader.close()  # delete the cached test batches
     print('%g epochs completed in %.3f hours.\n' % (epoch - start_epoch + 1, (time.time() - t0) / 3600))
     dist.destroy_process_group() if torch.cuda.device_count() > 1 else None
     torch.cuda.empty_cache()
@@ -416,13 +492,27 @@ if __name__ == '__main__':
     parser.add_argument('--multi-scale', action='store_true', help='adjust (67% - 150%) img_size every 10 batches')
     parser.add_argument('--img-size', nargs='+', type=int, default=[640], help='train and test image-sizes')
     parser.add_argument('--rect', action='store_true', help='rectangular training')
+    parser.add_argument('--img-weights', action='store_true', help='sample images weighted by class mAP and content')
     parser.add_argument('--resume', action='store_true', help='resume training from last.pt')
     parser.add_argument('--nosave', action='store_true', help='only save final checkpoint')
     parser.add_argument('--notest', action='store_true', help='only test final epoch')
     parser.add_argument('--evolve', action='store_true', help='evolve hyperparameters')
     parser.add_argument('--bucket', type=str, default='', help='gsutil bucket')
-    parser.add_argument('--cache-images', action='store_true', help='cache images for faster training')
+    parser.add_argument('--cache-images', nargs='?', const='ram', default='', choices=['ram', 'disk', 'shm', 'lru'],
+                        help='cache images for faster training (ram, memory-mapped disk file, shared memory or '
+                             'per-worker LRU of --cache-gb)')
+    parser.add_argument('--cache-gb', type=float, default=2.0, help='--cache-images lru budget per dataloader worker')
+    parser.add_argument('--workers', type=int, default=8, help='dataloader workers')
+    parser.add_argument('--autotune', action='store_true', help='calibrate dataloader workers and prefetch (cached)')
+    parser.add_argument('--timing', action='store_true', help='time dataset loading stages, saved to timing.txt')
+    parser.add_argument('--cache-val', action='store_true', help='cache letterboxed test batches after 1st test')
+    parser.add_argument('--shard-buffer', type=int, default=64, help='*.shards shuffle buffer images per worker')
+    parser.add_argument('--augment-ahead', type=int, default=0, help='augmentation producer processes (0 off)')
+    parser.add_argument('--ring-size', type=int, default=16, help='--augment-ahead ring size in batches')
+    parser.add_argument('--ring-reuse', type=int, default=1, help='serve a ring batch up to n times if producers lag')
+    parser.add_argument('--ring-file', type=str, default='', help='on-disk ring file (default shared memory)')
     parser.add_argument('--weights', type=str, default='weights/Grayscale_YOLOv3_SPP_2019.weights', help='initial weights')
+    parser.add_argument('--fold-rgb', action='store_true', help='fold RGB darknet --weights into a 1-channel --cfg')
     parser.add_argument('--arc', type=str, default='default', help='yolo architecture')  # default, uCE, uBCE
     parser.add_argument('--name', default='', help='renames results.txt to results_name.txt if supplied')
     parser.add_argument('--device', default='', help='device id (i.e. 0 or 0,1 or cpu)')
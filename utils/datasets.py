@@ -1,17 +1,26 @@
+import atexit
 import glob
+import inspect
+import json
 import math
 import os
+import platform
 import random
 import shutil
+import struct
 import time
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
-from threading import Thread
+from threading import Condition, Thread
 
 import cv2
 import numpy as np
 import torch
 from PIL import Image, ExifTags
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, Sampler
 from tqdm import tqdm
 
 from utils.utils import xyxy2xywh, xywh2xyxy
@@ -41,8 +50,22 @@ def exif_size(img):
     return s
 
 
+def image_shapes(files, desc='Reading image shapes'):
+    # Returns exif-corrected (width, height) of each image, (0, 0) if unreadable, read from file headers only by a pool
+    # of threads
+    def size(f):
+        try:
+            with Image.open(f) as img:  # lazy, pixel data is never decoded
+                return exif_size(img)
+        except Exception:  # missing or corrupted, reported by check_dataset.py or when loaded
+            return 0, 0
+
+    with ThreadPool(min(32, (os.cpu_count() or 1) + 4)) as pool:
+        return list(tqdm(pool.imap(size, files, chunksize=16), total=len(files), desc=desc))
+
+
 class LoadImages:  # for inference
-    def __init__(self, path, img_size=640, half=False):
+    def __init__(self, path, img_size=640, half=False, channels=3, reduce=False):
         path = str(Path(path))  # os-agnostic
         files = []
         if os.path.isdir(path):
@@ -55,11 +78,16 @@ class LoadImages:  # for inference
         nI, nV = len(images), len(videos)
 
         self.img_size = img_size
+        self.channels = channels  # 1 for grayscale model input
         self.files = images + videos
         self.nF = nI + nV  # number of files
         self.video_flag = [False] * nI + [True] * nV
         self.mode = 'images'
         self.half = half  # half precision fp16 images
+        self.reduce = reduce  # decode large JPEGs at a reduced scale, im0 (and results drawn on it) is then reduced
+        self.verbose = True  # print self.info for every image or frame read
+        self.info = ''
+        self.hw0 = None  # original hw of the last image or frame read, im0 may be reduced
         if any(videos):
             self.new_video(videos[0])  # new video
         else:
@@ -90,20 +118,32 @@ class LoadImages:  # for inference
                     ret_val, img0 = self.cap.read()
 
             self.frame += 1
-            print('video %g/%g (%g/%g) %s: ' % (self.count + 1, self.nF, self.frame, self.nframes, path), end='')
+            self.hw0 = img0.shape[:2]
+            self.info = 'video %g/%g (%g/%g) %s: ' % (self.count + 1, self.nF, self.frame, self.nframes, path)
 
         else:
             # Read image
             self.count += 1
-            img0 = cv2.imread(path)  # BGR
+            if self.reduce:
+                img0, self.hw0 = imread_reduced(path, self.img_size, self.channels)  # BGR or gray, orig hw
+            else:
+                img0 = cv2.imread(path, cv2.IMREAD_GRAYSCALE if self.channels == 1 else cv2.IMREAD_COLOR)  # BGR or gray
             assert img0 is not None, 'Image Not Found ' + path
-            print('image %g/%g %s: ' % (self.count, self.nF, path), end='')
+            if not self.reduce:
+                self.hw0 = img0.shape[:2]
+            self.info = 'image %g/%g %s: ' % (self.count, self.nF, path)
+        if self.verbose:
+            print(self.info, end='')
 
         # Padded resize
         img = letterbox(img0, new_shape=self.img_size)[0]
 
         # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
+        if self.channels == 1:
+            img = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)  # video frames are BGR
+            img = img[None]  # to 1x416x416
+        else:
+            img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         img = np.ascontiguousarray(img, dtype=np.float16 if self.half else np.float32)  # uint8 to fp16/fp32
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
 
@@ -119,10 +159,36 @@ class LoadImages:  # for inference
         return self.nF  # number of files
 
 
+def batch_images(dataset, batch_size=1):
+    # Groups consecutive LoadImages outputs with equal letterboxed shapes into batches of up to batch_size, never
+    # mixing frames of different video files. Yields lists of paths, n x c x h x w images, im0s, video (fps, w, h) or
+    # None for images, LoadImages info strings and original hw (im0s may be reduced)
+    dataset.verbose = False  # info is printed with the results instead
+    batch = []
+    for path, img, im0, cap in dataset:
+        video = None
+        if dataset.mode == 'video':  # properties read now, the capture is released at the end of each video
+            video = (cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                     int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        if batch and (len(batch) == batch_size or img.shape != batch[0][1].shape or
+                      ((video or batch[0][3]) and path != batch[0][0])):
+            yield collate_images(batch)
+            batch = []
+        batch.append((path, img, im0, video, dataset.info, dataset.hw0))
+    if batch:
+        yield collate_images(batch)
+
+
+def collate_images(batch):
+    paths, imgs, im0s, videos, infos, hw0s = zip(*batch)
+    return list(paths), np.stack(imgs, 0), list(im0s), list(videos), list(infos), list(hw0s)
+
+
 class LoadWebcam:  # for inference
-    def __init__(self, pipe=0, img_size=416, half=False):
+    def __init__(self, pipe=0, img_size=416, half=False, channels=3):
         self.img_size = img_size
         self.half = half  # half precision fp16 images
+        self.channels = channels  # 1 for grayscale model input
 
         if pipe == '0':
             pipe = 0  # local camera
@@ -176,7 +242,10 @@ class LoadWebcam:  # for inference
         img = letterbox(img0, new_shape=self.img_size)[0]
 
         # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
+        if self.channels == 1:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)[None]  # to 1x416x416
+        else:
+            img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
         img = np.ascontiguousarray(img, dtype=np.float16 if self.half else np.float32)  # uint8 to fp16/fp32
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
 
@@ -187,10 +256,18 @@ class LoadWebcam:  # for inference
 
 
 class LoadStreams:  # multiple IP or RTSP cameras
-    def __init__(self, sources='streams.txt', img_size=416, half=False):
+    # One grabber thread per stream keeps only its latest frame, every decimate-th frame is retrieved (decoded). Each
+    # retrieved frame gets a sequence number, and __next__ waits on a condition variable until every stream has a new
+    # frame (or timeout seconds passed, then stale frames are reused). Per stream counters: captured frames, dropped
+    # frames (replaced before being consumed) and duplicated frames (consumed again)
+    def __init__(self, sources='streams.txt', img_size=416, half=False, channels=3, decimate=4, timeout=1.0):
         self.mode = 'images'
         self.img_size = img_size
         self.half = half  # half precision fp16 images
+        self.channels = channels  # 1 for grayscale model input
+        self.decimate = max(decimate, 1)
+        self.timeout = timeout
+        self.cond = Condition()
 
         if os.path.isfile(sources):
             with open(sources, 'r') as f:
@@ -200,6 +277,10 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
         n = len(sources)
         self.imgs = [None] * n
+        self.seq = [0] * n  # sequence number of the latest frame per stream
+        self.consumed = [0] * n  # sequence number of the last frame returned per stream
+        self.alive = [True] * n
+        self.counts = [{'captured': 0, 'dropped': 0, 'duplicated': 0} for _ in range(n)]
         self.sources = sources
         for i, s in enumerate(sources):
             # Start the thread to read frames from the video stream
@@ -210,6 +291,8 @@ class LoadStreams:  # multiple IP or RTSP cameras
             h = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
             fps = cap.get(cv2.CAP_PROP_FPS) % 100
             _, self.imgs[i] = cap.read()  # guarantee first frame
+            self.seq[i] = 1
+            self.counts[i]['captured'] = 1
             thread = Thread(target=self.update, args=([i, cap]), daemon=True)
             print(' success (%gx%g at %.2f FPS).' % (w, h, fps))
             thread.start()
@@ -222,16 +305,24 @@ class LoadStreams:  # multiple IP or RTSP cameras
             print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
 
     def update(self, index, cap):
-        # Read next stream frame in a daemon thread
+        # Grab stream frames in a daemon thread, blocking on the stream itself, and keep every decimate-th one
         n = 0
-        while cap.isOpened():
+        while cap.isOpened() and cap.grab():
             n += 1
-            # _, self.imgs[index] = cap.read()
-            cap.grab()
-            if n == 4:  # read every 4th frame
-                _, self.imgs[index] = cap.retrieve()
-                n = 0
-            time.sleep(0.01)  # wait time
+            if n % self.decimate == 0:
+                ok, img = cap.retrieve()
+                if not ok:
+                    continue
+                with self.cond:
+                    c = self.counts[index]
+                    c['captured'] += 1
+                    c['dropped'] += self.seq[index] > self.consumed[index]  # previous frame never consumed
+                    self.imgs[index] = img
+                    self.seq[index] += 1
+                    self.cond.notify_all()
+        with self.cond:
+            self.alive[index] = False  # stream ended
+            self.cond.notify_all()
 
     def __iter__(self):
         self.count = -1
@@ -239,36 +330,405 @@ class LoadStreams:  # multiple IP or RTSP cameras
 
     def __next__(self):
         self.count += 1
-        img0 = self.imgs.copy()
-        if cv2.waitKey(1) == ord('q'):  # q to quit
-            cv2.destroyAllWindows()
-            raise StopIteration
-
-        # Letterbox
+        with self.cond:  # wait for a new frame from every live stream
+            new = lambda: all(s > c or not a for s, c, a in zip(self.seq, self.consumed, self.alive))
+            self.cond.wait_for(new, timeout=self.timeout)
+            if not any(self.alive) and not any(s > c for s, c in zip(self.seq, self.consumed)):
+                raise StopIteration
+            for i, (s, c) in enumerate(zip(self.seq, self.consumed)):
+                self.counts[i]['duplicated'] += s == c
+            self.consumed = self.seq.copy()
+            img0 = self.imgs.copy()  # frames are replaced, never modified, by the grabber threads
+        return self.sources, self.stack(img0), img0, None
+
+    def stack(self, img0):
+        # Returns the letterboxed, stacked and normalized model input of one frame per stream
         img = [letterbox(x, new_shape=self.img_size, auto=self.rect, interp=cv2.INTER_AREA)[0] for x in img0]
 
         # Stack
         img = np.stack(img, 0)
 
         # Convert
-        img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to 3x416x416, uint8 to float32
+        if self.channels == 1:
+            img = np.stack([cv2.cvtColor(x, cv2.COLOR_BGR2GRAY) for x in img], 0)[:, None]  # to bsx1x416x416
+        else:
+            img = img[:, :, :, ::-1].transpose(0, 3, 1, 2)  # BGR to RGB, to 3x416x416, uint8 to float32
         img = np.ascontiguousarray(img, dtype=np.float16 if self.half else np.float32)
         img /= 255.0  # 0 - 255 to 0.0 - 1.0
-
-        return self.sources, img, img0, None
+        return img
 
     def __len__(self):
         return 0  # 1E12 frames = 32 streams at 30 FPS for 30 years
 
+    def info(self):
+        # Returns per stream captured, dropped and duplicated frame counts
+        with self.cond:
+            return '\n'.join('%s: %g captured, %g dropped, %g duplicated' % (s, c['captured'], c['dropped'],
+                                                                              c['duplicated'])
+                             for s, c in zip(self.sources, self.counts))
+
+
+class FrameRing:  # BGR video frames in a shared-memory ring, written by decoder processes or external capture software
+    # Layout of the segment (little-endian), attach with FrameRing(name, external=True):
+    #   header  64 bytes    magic b'FRNG', version u16, channels u16, streams u32, slots u32, height u32, width u32
+    #   streams 16 bytes/stream  latest frame seq u64 (0 = no frame yet), ended u64 (1 = stream ended)
+    #   slots   16 bytes/slot    frame seq u64, frame height u32, frame width u32, slot k of stream s at s * slots + k
+    #   frames  height * width * channels bytes/slot, uint8 BGR rows of frame width, same slot order
+    # Writers store frame seq n of a stream in slot (n - 1) % slots: slot seq = 0, frame, shape, slot seq = n, then the
+    # stream latest seq = n. Readers copy the latest slot and keep the copy only if its slot seq is still n afterwards.
+    header = struct.Struct('<4sHHIIII')
+    stream_dtype = np.dtype([('seq', '<u8'), ('ended', '<u8')])
+    slot_dtype = np.dtype([('seq', '<u8'), ('h', '<u4'), ('w', '<u4')])
+
+    def __init__(self, name=None, streams=1, slots=4, height=1080, width=1920, channels=3, external=False):
+        from multiprocessing import shared_memory, resource_tracker  # python >= 3.8
+        self.owner = name is None
+        if self.owner:  # create
+            self.streams, self.slots, self.height, self.width, self.channels = streams, slots, height, width, channels
+            self.shm = shared_memory.SharedMemory(create=True, size=self.nbytes())
+            self.header.pack_into(self.shm.buf, 0, b'FRNG', 1, channels, streams, slots, height, width)
+            atexit.register(self.close)
+        else:  # attach
+            self.shm = shared_memory.SharedMemory(name=name)
+            if external:  # attached from a process the creator did not start, its own tracker must not unlink
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            magic, version, self.channels, self.streams, self.slots, self.height, self.width = \
+                self.header.unpack_from(self.shm.buf, 0)
+            assert magic == b'FRNG' and version == 1, 'Not a version 1 frame ring: %s' % name
+        self.name = self.shm.name
+        s, k, buf = self.streams, self.slots, self.shm.buf
+        self.state = np.ndarray((s,), dtype=self.stream_dtype, buffer=buf, offset=64)
+        self.slot = np.ndarray((s, k), dtype=self.slot_dtype, buffer=buf, offset=64 + 16 * s)
+        self.frames = np.ndarray((s, k, self.height, self.width, self.channels), dtype=np.uint8, buffer=buf,
+                                 offset=64 + 16 * s + 16 * s * k)
+
+    def nbytes(self):
+        s, k = self.streams, self.slots
+        return 64 + 16 * s + 16 * s * k + s * k * self.height * self.width * self.channels
+
+    def write(self, stream, img):
+        # Publishes BGR image img as the next frame of stream, downscaling it if larger than the ring frame size
+        h, w = img.shape[:2]
+        r = min(self.height / h, self.width / w)
+        if r < 1:
+            h, w = int(h * r), int(w * r)
+            img = cv2.resize(img, (w, h), interpolation=cv2.INTER_AREA)
+        n = int(self.state['seq'][stream]) + 1
+        k = (n - 1) % self.slots
+        self.slot['seq'][stream, k] = 0  # writing
+        self.frames[stream, k, :h, :w] = img.reshape(h, w, self.channels)
+        self.slot['h'][stream, k], self.slot['w'][stream, k] = h, w
+        self.slot['seq'][stream, k] = n
+        self.state['seq'][stream] = n
+
+    def read(self, stream):
+        # Returns (seq, copy of the latest frame) of stream, (0, None) before its first frame
+        while True:
+            n = int(self.state['seq'][stream])
+            if n == 0:
+                return 0, None
+            k = (n - 1) % self.slots
+            h, w = int(self.slot['h'][stream, k]), int(self.slot['w'][stream, k])
+            img = self.frames[stream, k, :h, :w].copy()
+            if int(self.slot['seq'][stream, k]) == n:  # not overwritten while copying
+                return n, img
+
+    def end(self, stream):
+        self.state['ended'][stream] = 1
+
+    def close(self):
+        if self.shm is not None:
+            self.state = self.slot = self.frames = None  # release views before closing
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+
+def frame_decoder(source, name, stream, decimate=1):
+    # FrameRing decoder process: writes every decimate-th frame of video source into stream of ring name
+    ring = FrameRing(name)
+    cap = cv2.VideoCapture(0 if source == '0' else source)
+    n = 0
+    while cap.isOpened() and cap.grab():
+        n += 1
+        if n % decimate == 0:
+            ok, img = cap.retrieve()
+            if ok:
+                ring.write(stream, img)
+    ring.end(stream)
+    ring.close()
+
+
+class LoadFrameRing(LoadStreams):  # multiple video streams decoded out of process into a FrameRing
+    # sources 'shm://<name>' attaches to a ring fed by other software, else one decoder process is started per source.
+    # Frames are polled from shared memory (there is no cross-process condition), __next__ returns like LoadStreams
+    def __init__(self, sources='streams.txt', img_size=416, half=False, channels=3, decimate=4, timeout=1.0, slots=4):
+        import multiprocessing as mp
+        self.mode = 'images'
+        self.img_size = img_size
+        self.half = half  # half precision fp16 images
+        self.channels = channels  # 1 for grayscale model input
+        self.timeout = timeout
+        self.decoders = []
+
+        if sources.startswith('shm://'):  # attach
+            self.ring = FrameRing(sources[6:], external=True)
+            sources = ['%s/%g' % (sources, i) for i in range(self.ring.streams)]
+        else:
+            if os.path.isfile(sources):
+                with open(sources, 'r') as f:
+                    sources = [x.strip() for x in f.read().splitlines() if len(x.strip())]
+            else:
+                sources = [sources]
+            shapes = []
+            for s in sources:  # probe frame sizes
+                cap = cv2.VideoCapture(0 if s == '0' else s)
+                assert cap.isOpened(), 'Failed to open %s' % s
+                shapes.append((int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))))
+                cap.release()
+            h, w = np.max(shapes, 0).tolist()
+            self.ring = FrameRing(streams=len(sources), slots=slots, height=h, width=w)
+            print('Decoding %g streams into shared memory frame ring %s (%.1fMB)' %
+                  (len(sources), self.ring.name, self.ring.nbytes() / 1E6))
+            self.decoders = [mp.Process(target=frame_decoder, args=(s, self.ring.name, i, max(decimate, 1)),
+                                        daemon=True) for i, s in enumerate(sources)]
+            for p in self.decoders:
+                p.start()
+            atexit.register(self.close)
+        assert self.ring.channels == 3, 'Frame ring must hold BGR frames'
+
+        n = len(sources)
+        self.sources = sources
+        self.imgs = [None] * n
+        self.seq = [0] * n
+        self.consumed = [0] * n
+        self.counts = [{'captured': 0, 'dropped': 0, 'duplicated': 0} for _ in range(n)]
+        self.cond = Condition()  # guards counts for info()
+        t = time.time()
+        while not all(self.ring.state['seq'] | self.ring.state['ended']) and time.time() - t < 30:  # first frames
+            time.sleep(0.01)
+        for i in range(n):
+            self.seq[i], self.imgs[i] = self.ring.read(i)
+            assert self.imgs[i] is not None, 'No frames received from %s' % sources[i]
+        self.consumed = [x - 1 for x in self.seq]  # first frames are new
+
+        # check for common shapes
+        s = np.stack([letterbox(x, new_shape=self.img_size)[0].shape for x in self.imgs], 0)  # inference shapes
+        self.rect = np.unique(s, axis=0).shape[0] == 1  # rect inference if all shapes equal
+        if not self.rect:
+            print('WARNING: Different stream shapes detected. For optimal performance supply similarly-shaped streams.')
+
+    def __next__(self):
+        self.count += 1
+        ring, t = self.ring, time.time()
+        while True:  # wait for a new frame from every live stream
+            latest, ended = ring.state['seq'].tolist(), ring.state['ended'].tolist()
+            if all(s > c or e for s, c, e in zip(latest, self.consumed, ended)) or time.time() - t > self.timeout:
+                break
+            time.sleep(0.001)
+        if all(ended) and not any(s > c for s, c in zip(latest, self.consumed)):
+            raise StopIteration
+        with self.cond:
+            for i, c in enumerate(self.consumed):
+                self.seq[i], self.imgs[i] = ring.read(i)  # fresh copy, also of a duplicated frame
+                n = self.seq[i] - c
+                self.counts[i]['captured'] += n
+                self.counts[i]['dropped'] += max(n - 1, 0)
+                self.counts[i]['duplicated'] += n == 0
+            self.consumed = self.seq.copy()
+            img0 = self.imgs.copy()
+        return self.sources, self.stack(img0), img0, None
+
+    def close(self):
+        for p in self.decoders:
+            p.terminate()
+        self.decoders = []
+        self.ring.close()
+
+
+def img_list(path, manifest=None):
+    # Returns the image files of an image list *.txt, or of a *.manifest (see update_manifest())
+    if path.endswith('.manifest'):
+        files = list(load_manifest(path) if manifest is None else manifest)
+    else:
+        with open(path, 'r') as f:
+            files = [x.replace('/', os.sep) for x in f.read().splitlines()]  # os-agnostic
+    return [x for x in files if os.path.splitext(x)[-1].lower() in img_formats]
+
+
+# Manifest columns (tab-separated, one image per line, label_size -1 and labels -1 if the label file is missing)
+manifest_columns = ('img_file', 'size', 'mtime_ns', 'w', 'h', 'label_size', 'label_mtime_ns', 'labels', 'classes')
+
+
+def load_manifest(path):
+    # Returns {img_file: [size, mtime_ns, w, h, label_size, label_mtime_ns, labels, classes]} of a *.manifest, with
+    # classes the class histogram string 'class:count,...', {} if there is no manifest
+    manifest = OrderedDict()
+    try:
+        with open(path, 'r') as f:
+            for x in f.read().splitlines():
+                x = x.split('\t')
+                if len(x) == len(manifest_columns) and not x[0].startswith('#'):
+                    manifest[x[0].replace('/', os.sep)] = [int(v) for v in x[1:8]] + [x[8]]
+    except OSError:
+        pass
+    return manifest
+
+
+def update_manifest(path='data/FLIR_Train.manifest', folders=('data/images/train',)):  # update_manifest()
+    # Updates a dataset manifest in place from its image folders (searched recursively). Only images and labels that
+    # are new or changed (size or mtime) since the last update are read, deleted ones are dropped. The *.manifest
+    # can replace an image list *.txt in *.data files, and LoadImagesAndLabels then takes image shapes and label
+    # file stats from it instead of the *.shapes file and os.stat()
+    old = load_manifest(path)
+    files = sorted(str(p) for d in folders for p in Path(d).rglob('*') if p.suffix.lower() in img_formats)
+
+    manifest, new, nl = OrderedDict(), [], 0  # new or changed images, (re)read label files
+    for x in tqdm(files, desc='Scanning %s' % ', '.join(folders)):
+        st = os.stat(x)
+        r = old.get(x)
+        changed = r is None or r[:2] != [st.st_size, st.st_mtime_ns]
+        if changed:
+            r = [st.st_size, st.st_mtime_ns, 0, 0, -1, 0, -1, '']
+            new.append(x)
+
+        try:
+            st = os.stat(img2label_path(x))
+            key = [st.st_size, st.st_mtime_ns]
+        except OSError:
+            key = [-1, 0]  # label file missing
+        if r[4:6] != key or changed:
+            r[4:8] = key + [-1, '']
+            if key[0] >= 0:
+                nl += 1
+                try:
+                    with open(img2label_path(x), 'r') as f:
+                        c = [int(float(l.split()[0])) for l in f.read().splitlines() if l.strip()]
+                    r[6] = len(c)
+                    r[7] = ','.join('%g:%g' % kv for kv in sorted(Counter(c).items()))
+                except (OSError, ValueError):
+                    print('WARNING: unreadable labels %s' % img2label_path(x))
+        manifest[x] = r
+
+    for x, wh in zip(new, image_shapes(new)):  # header-only shape reads for new and changed images
+        manifest[x][2:4] = map(int, wh)
+
+    with open(path + '.tmp', 'w') as f:
+        f.write('# ' + '\t'.join(manifest_columns) + '\n')
+        f.writelines('\t'.join(str(v) for v in [x] + r) + '\n' for x, r in manifest.items())
+    os.replace(path + '.tmp', path)  # atomic
+    print('Manifest %s updated: %g images (%g new or changed, %g removed), %g label files read' %
+          (path, len(manifest), len(new), len([x for x in old if x not in manifest]), nl))
+    return manifest
+
+
+def img2label_path(img_file):
+    # Returns the label *.txt path of an image, i.e. .../images/FLIR_00001.jpeg -> .../labels/FLIR_00001.txt
+    return img_file.replace('images', 'labels').replace(os.path.splitext(img_file)[-1], '.txt')
+
+
+def report_path(path):
+    # Returns the check_dataset.py report path of an image list
+    return os.path.splitext(str(Path(path)))[0] + '.report'
+
+
+def load_report(path):
+    # Returns {img_file: {statuses}} of the entries flagged in the check_dataset.py report of an image list, {} if none
+    report = {}
+    try:
+        with open(report_path(path), 'r') as f:
+            for x in f.read().splitlines():
+                x = x.split('\t')
+                if len(x) >= 2 and not x[0].startswith('#'):
+                    report.setdefault(x[1], set()).add(x[0])
+    except OSError:
+        pass
+    return report
+
+
+def check_entry(img_file):
+    # Returns (status, detail) of one image and its labels for check_dataset(), status '' if valid
+    if not os.path.isfile(img_file):
+        return 'missing', 'image not found'
+    warning = ('', '')
+    try:
+        with open(img_file, 'rb') as f:
+            b = f.read()
+        eoi = not is_jpeg(img_file) or b.rstrip(b'\0').endswith(b'\xff\xd9')  # JPEG ends with EOI marker
+        img = cv2.imdecode(np.frombuffer(b, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+        if img is None or img.size == 0:
+            return 'bad', 'image not decoded' if eoi else 'truncated JPEG (no EOI marker), not decoded'
+        if not eoi:  # decodes, i.e. trailing metadata or padding after the EOI marker
+            warning = ('warning', 'JPEG does not end with EOI marker (trailing data or truncated), decoded')
+    except Exception as e:
+        return 'bad', 'image %s' % e
+
+    label_file = img2label_path(img_file)
+    if not os.path.isfile(label_file):
+        return 'empty', 'label file not found'
+    try:
+        with open(label_file, 'r') as f:
+            l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
+    except Exception as e:
+        return 'bad', 'labels %s' % e
+    if l.shape[0] == 0:
+        return 'empty', 'no labels'
+    if l.ndim != 2 or l.shape[1] != 5:
+        return 'bad', 'labels need 5 columns'
+    if (l < 0).any():
+        return 'bad', 'negative labels'
+    if (l[:, 1:] > 1).any():
+        return 'bad', 'non-normalized or out of bounds coordinate labels'
+    return warning
+
+
+def check_dataset(path='data/FLIR_Train.txt', workers=None):  # from utils.datasets import *; check_dataset()
+    # Validates all images and labels of an image list in a pool of processes and writes the flagged entries to a
+    # <list>.report file (tab-separated status, img_file, detail), which LoadImagesAndLabels reads to skip them:
+    #   bad        corrupted or undecodable image, or malformed labels (skipped)
+    #   missing    image file not found (skipped)
+    #   duplicate  image listed more than once (repeats skipped)
+    #   empty      no label file or no labels (kept, as background images)
+    #   warning    image decodes but looks damaged, i.e. JPEG without EOI marker at the end (kept)
+    path = str(Path(path))
+    files = img_list(path)
+    unique = list(OrderedDict.fromkeys(files))  # each image checked once
+    report = [('duplicate', x, 'listed %g times' % n) for x, n in Counter(files).items() if n > 1]
+    with Pool(workers) as pool:
+        results = list(tqdm(pool.imap(check_entry, unique, chunksize=64), total=len(unique), desc='Checking %s' % path))
+    report += [(s, x, d) for x, (s, d) in zip(unique, results) if s]
+
+    counts = {k: sum(r[0] == k for r in report) for k in ('bad', 'missing', 'duplicate', 'empty', 'warning')}
+    with open(report_path(path), 'w') as f:
+        f.write('# check_dataset.py report for %s, %g images: %s\n' %
+                (path, len(files), ', '.join('%g %s' % (v, k) for k, v in counts.items())))
+        f.writelines('%s\t%s\t%s\n' % r for r in sorted(report))
+    print('%g images checked, %s. Report saved to %s' %
+          (len(unique), ', '.join('%g %s' % (v, k) for k, v in counts.items()), report_path(path)))
+    return counts
+
 
 class LoadImagesAndLabels(Dataset):  # for training/testing
     def __init__(self, path, img_size=416, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_labels=False, cache_images=False, single_cls=False):
+                 cache_labels=False, cache_images=False, single_cls=False, channels=3, cache_bytes=2E9):
         path = str(Path(path))  # os-agnostic
         assert os.path.isfile(path), 'File not found %s. See %s' % (path, help_url)
-        with open(path, 'r') as f:
-            self.img_files = [x.replace('/', os.sep) for x in f.read().splitlines()  # os-agnostic
-                              if os.path.splitext(x)[-1].lower() in img_formats]
+        manifest = load_manifest(path) if path.endswith('.manifest') else None  # see update_manifest()
+        self.img_files = img_list(path, manifest)
+
+        # Skip entries flagged by check_dataset.py (bad or missing images and labels, repeated entries)
+        report = load_report(path)
+        if report:
+            seen, files = set(), []
+            for x in self.img_files:
+                s = report.get(x, ())
+                if 'bad' in s or 'missing' in s or ('duplicate' in s and x in seen):
+                    continue
+                seen.add(x)
+                files.append(x)
+            print('Skipping %g entries flagged in %s' % (len(self.img_files) - len(files), report_path(path)))
+            self.img_files = files
 
         n = len(self.img_files)
         assert n > 0, 'No images found in %s. See %s' % (path, help_url)
@@ -280,27 +740,41 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         self.img_size = img_size
         self.augment = augment
         self.hyp = hyp
+        self.channels = channels  # 1 to load, cache and augment images as single-channel grayscale
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
 
         # Define labels
-        self.label_files = [x.replace('images', 'labels').replace(os.path.splitext(x)[-1], '.txt')
-                            for x in self.img_files]
+        self.label_files = [img2label_path(x) for x in self.img_files]
 
-        # Rectangular Training  https://github.com/ultralytics/yolov3/issues/232
-        if self.rect:
-            # Read image shapes (wh)
-            sp = path.replace('.txt', '.shapes')  # shapefile path
+        # Read image shapes (wh), used to pick reduced JPEG decoding without opening each image twice
+        if manifest is not None:
+            s = [manifest[x][2:4] for x in self.img_files]
+        else:
+            sp = os.path.splitext(path)[0] + '.shapes'  # shapefile path, lines of 'w h img_file'
+            shapes = {}
             try:
                 with open(sp, 'r') as f:  # read existing shapefile
-                    s = [x.split() for x in f.read().splitlines()]
-                    assert len(s) == n, 'Shapefile out of sync'
-            except:
-                s = [exif_size(Image.open(f)) for f in tqdm(self.img_files, desc='Reading image shapes')]
-                np.savetxt(sp, s, fmt='%g')  # overwrites existing (if any)
+                    for x in f.read().splitlines():
+                        x = x.split(maxsplit=2)
+                        if len(x) == 3:  # skip lines from old 'w h' shapefiles
+                            shapes[x[2]] = x[:2]
+            except OSError:
+                pass
+            new = [x for x in self.img_files if x not in shapes]
+            if new:  # only read the images missing from the shapefile
+                shapes.update(zip(new, image_shapes(new)))
+                with open(sp, 'w') as f:  # unreadable images are left out and read again next time
+                    f.writelines('%s %s %s\n' % (*shapes[x], x) for x in self.img_files if int(shapes[x][0]))
+            s = [shapes[x] for x in self.img_files]
+        s = np.array(s, dtype=np.float64)
+        self.shapes = s  # wh
+
+        # Rectangular Training  https://github.com/ultralytics/yolov3/issues/232
+        if self.rect:
+            assert s.min() > 0, 'Image shape not readable %s' % self.img_files[s.min(1).argmin()]
 
             # Sort by aspect ratio
-            s = np.array(s, dtype=np.float64)
             ar = s[:, 1] / s[:, 0]  # aspect ratio
             i = ar.argsort()
             self.img_files = [self.img_files[i] for i in i]
@@ -308,17 +782,9 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             self.shapes = s[i]  # wh
             ar = ar[i]
 
-            # Set training image shapes
-            shapes = [[1, 1]] * nb
-            for i in range(nb):
-                ari = ar[bi == i]
-                mini, maxi = ari.min(), ari.max()
-                if maxi < 1:
-                    shapes[i] = [maxi, 1]
-                elif mini > 1:
-                    shapes[i] = [1, 1 / mini]
-
-            self.batch_shapes = np.ceil(np.array(shapes) * img_size / 32.).astype(np.int) * 32
+            # Set training image shapes (fixed consecutive batches, see AspectRatioBatchSampler for shuffled batches)
+            self.ar = ar
+            self.batch_shapes = np.stack([batch_shape(ar[bi == i], img_size) for i in range(nb)])
 
         # Preload labels (required for weighted CE training)
         self.imgs = [None] * n
@@ -327,23 +793,20 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             self.labels = [np.zeros((0, 5))] * n
             extract_bounding_boxes = False
             create_datasubset = False
+            cache = self.cache_labels(path, manifest)  # {label_file: (size_mtime, labels, duplicate)}
             pbar = tqdm(self.label_files, desc='Caching labels')
             nm, nf, ne, ns, nd = 0, 0, 0, 0, 0  # number missing, found, empty, datasubset, duplicate
             for i, file in enumerate(pbar):
-                try:
-                    with open(file, 'r') as f:
-                        l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
-                except:
+                _, l, duplicate = cache[file]
+                if l is None:
                     nm += 1  # print('missing labels for image %s' % self.img_files[i])  # file missing
                     continue
 
                 if l.shape[0]:
-                    assert l.shape[1] == 5, '> 5 label columns: %s' % file
-                    assert (l >= 0).all(), 'negative labels: %s' % file
-                    assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels: %s' % file
-                    if np.unique(l, axis=0).shape[0] < l.shape[0]:  # duplicate rows
+                    if duplicate:  # duplicate rows
                         nd += 1  # print('WARNING: duplicate rows in %s' % self.label_files[i])  # duplicate rows
                     if single_cls:
+                        l = l.copy()
                         l[:, 0] = 0  # force dataset into single-class mode
                     self.labels[i] = l
                     nf += 1  # file found
@@ -386,8 +849,20 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                     nf, nm, ne, nd, n)
             assert nf > 0, 'No labels found. See %s' % help_url
 
+        # Cache recently loaded images in each dataloader worker, up to cache_bytes per worker
+        self.lru = ImageLRU(cache_bytes) if cache_images == 'lru' else None
+        self.timer = None  # StageTimer() to time loading stages
+
+        # Cache images into a memory-mapped file, shared by all dataloader workers and reused across runs
+        if cache_images == 'disk':
+            self.imgs, self.img_hw0, self.img_hw = self.cache_images_disk(path)
+
+        # Cache images into one shared-memory segment, shared with other datasets using the same SharedImageCache
+        elif isinstance(cache_images, SharedImageCache):
+            self.imgs, self.img_hw0, self.img_hw = cache_images.add(self)  # filled by cache_images.build()
+
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
-        if cache_images:  # if training
+        elif cache_images in (True, 'ram'):  # if training
             gb = 0  # Gigabytes of cached images
             pbar = tqdm(range(len(self.img_files)), desc='Caching images')
             self.img_hw0, self.img_hw = [None] * n, [None] * n
@@ -396,19 +871,114 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 gb += self.imgs[i].nbytes
                 pbar.desc = 'Caching images (%.1fGB)' % (gb / 1E9)
 
-        # Detect corrupted images https://medium.com/joelthchao/programmatically-detect-corrupted-image-8c1b2006c3d3
-        detect_corrupted_images = False
-        if detect_corrupted_images:
-            from skimage import io  # conda install -c conda-forge scikit-image
-            for file in tqdm(self.img_files, desc='Detecting corrupted images'):
-                try:
-                    _ = io.imread(file)
-                except:
-                    print('Corrupted image detected: %s' % file)
-
     def __len__(self):
         return len(self.img_files)
 
+    def cache_labels(self, path, manifest=None):
+        # Returns {label_file: (size_mtime, labels, duplicate)} from a persistent *.labels.npy cache next to the list
+        # file, re-reading and validating only label files that are new or changed since the cache was written.
+        # Label file sizes and mtimes come from the manifest if given, else from os.stat()
+        cp = os.path.splitext(path)[0] + '.labels.npy'  # cache path
+        try:
+            cache = np.load(cp, allow_pickle=True).item()
+        except:
+            cache = {}
+
+        labels, nu = {}, 0  # labels, number of label files (re)read
+        for img, file in zip(self.img_files, self.label_files):
+            if manifest is not None:
+                r = manifest[img]
+                key = (r[4], r[5]) if r[4] >= 0 else None  # None if file missing
+            else:
+                try:
+                    st = os.stat(file)
+                    key = st.st_size, st.st_mtime_ns
+                except OSError:
+                    key = None  # file missing
+
+            x = cache.get(file)
+            if x is not None and x[0] == key:  # unchanged since last cache
+                labels[file] = x
+                continue
+
+            nu += 1
+            try:
+                with open(file, 'r') as f:
+                    l = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
+            except:
+                labels[file] = (key, None, False)  # missing or unreadable
+                continue
+
+            duplicate = False
+            if l.shape[0]:
+                assert l.shape[1] == 5, '> 5 label columns: %s' % file
+                assert (l >= 0).all(), 'negative labels: %s' % file
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels: %s' % file
+                duplicate = np.unique(l, axis=0).shape[0] < l.shape[0]  # duplicate rows
+            labels[file] = (key, l, duplicate)
+
+        if nu or len(labels) != len(cache):  # save updated cache
+            try:
+                with open(cp + '.tmp', 'wb') as f:
+                    np.save(f, labels)
+                os.replace(cp + '.tmp', cp)  # atomic, safe for concurrent evolve runs
+                print('Label cache %s updated (%g of %g label files read)' % (cp, nu, len(labels)))
+            except OSError:
+                print('WARNING: could not write label cache %s' % cp)
+        return labels
+
+    def cache_images_disk(self, path):
+        # Writes resized load_image() outputs once to a *.imgcache file next to the list file, with an index of
+        # (offset, shape) per image. Only images that are new or changed since the last run are decoded again.
+        # Runs sharing the file build it one at a time. Images are only ever appended, rewrites go to a new file that
+        # replaces the old one, so files other runs have memory-mapped are never truncated.
+        f = '%s_%g%s%s.imgcache' % (os.path.splitext(path)[0], self.img_size, 'a' if self.augment else '',
+                                    'g' if self.channels == 1 else '')
+        with file_lock(f + '.lock'):
+            try:
+                index = np.load(f + '.npy', allow_pickle=True).item()  # {img_file: (size_mtime, offset, hw0, shape)}
+            except:
+                index = {}
+            if not os.path.isfile(f):
+                index = {}
+
+            keys = []  # (size, mtime_ns) of each source image
+            for file in self.img_files:
+                st = os.stat(file)
+                keys.append((st.st_size, st.st_mtime_ns))
+            new = [i for i, (file, key) in enumerate(zip(self.img_files, keys)) if index.get(file, [None])[0] != key]
+
+            if new:
+                # Rewrite from scratch if more than half of the existing file would be stale
+                changed = {self.img_files[i] for i in new}
+                live = sum(int(np.prod(x[3])) for k, x in index.items() if k not in changed)  # bytes still referenced
+                if index and os.path.getsize(f) > 2 * live:
+                    index, new = {}, list(range(self.n))
+
+                rewrite = not index
+                offset = 0 if rewrite else os.path.getsize(f)
+                gb = 0  # Gigabytes written
+                pbar = tqdm(new, desc='Caching images to %s' % f)
+                with open(f + '.tmp' if rewrite else f, 'wb' if rewrite else 'ab') as fo:
+                    for i in pbar:
+                        img, hw0, hw = load_image(self, i)
+                        img = np.ascontiguousarray(img)
+                        fo.write(img.data)
+                        index[self.img_files[i]] = (keys[i], offset, hw0, img.shape)
+                        offset += img.nbytes
+                        gb += img.nbytes
+                        pbar.desc = 'Caching images to %s (%.1fGB)' % (f, gb / 1E9)
+                if rewrite:
+                    os.replace(f + '.tmp', f)
+                with open(f + '.npy.tmp', 'wb') as fo:
+                    np.save(fo, index)
+                os.replace(f + '.npy.tmp', f + '.npy')
+
+            x = [index[file] for file in self.img_files]
+            imgs = MmapImages(f, [(offset, shape) for _, offset, _, shape in x])
+            imgs.open()  # mapped while locked, forked workers share this mapping
+        return imgs, [hw0 for _, _, hw0, _ in x], [shape[:2] for _, _, _, shape in x]
+
     # def __iter__(self):
     #     self.count = -1
     #     print('ran dataset iter')
@@ -416,43 +986,44 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
     #     return self
 
     def __getitem__(self, index):
-        if self.image_weights:
-            index = self.indices[index]
+        shape = None
+        if isinstance(index, tuple):  # (index, letterboxed shape) from AspectRatioBatchSampler
+            index, shape = index
 
         img_path = self.img_files[index]
-        label_path = self.label_files[index]
 
         hyp = self.hyp
-        mosaic = True and self.augment  # load 4 images at a time into a mosaic (only during training)
+        t = t0 = time.perf_counter()  # stage timing, see StageTimer
+        mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
         if mosaic:
             # Load mosaic
             img, labels = load_mosaic(self, index)
             shapes = None
+            t = time.perf_counter()  # stages timed inside load_mosaic()
 
         else:
             # Load image
             img, (h0, w0), (h, w) = load_image(self, index)
+            t = tick(self, 'decode', t)
 
             # Letterbox
-            shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
+            if shape is None:
+                shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
+            t = tick(self, 'letterbox', t)
 
             # Load labels
             labels = []
-            if os.path.isfile(label_path):
-                x = self.labels[index]
-                if x is None:  # labels not preloaded
-                    with open(label_path, 'r') as f:
-                        x = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
-
-                if x.size > 0:
-                    # Normalized xywh to pixel xyxy format
-                    labels = x.copy()
-                    labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]  # pad width
-                    labels[:, 2] = ratio[1] * h * (x[:, 2] - x[:, 4] / 2) + pad[1]  # pad height
-                    labels[:, 3] = ratio[0] * w * (x[:, 1] + x[:, 3] / 2) + pad[0]
-                    labels[:, 4] = ratio[1] * h * (x[:, 2] + x[:, 4] / 2) + pad[1]
+            x = load_labels(self, index)
+            if x is not None and x.size > 0:
+                # Normalized xywh to pixel xyxy format
+                labels = x.copy()
+                labels[:, 1] = ratio[0] * w * (x[:, 1] - x[:, 3] / 2) + pad[0]  # pad width
+                labels[:, 2] = ratio[1] * h * (x[:, 2] - x[:, 4] / 2) + pad[1]  # pad height
+                labels[:, 3] = ratio[0] * w * (x[:, 1] + x[:, 3] / 2) + pad[0]
+                labels[:, 4] = ratio[1] * h * (x[:, 2] + x[:, 4] / 2) + pad[1]
+            t = tick(self, 'labels', t)
 
         if self.augment:
             # Augment imagespace
@@ -462,9 +1033,11 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                                             translate=hyp['translate'],
                                             scale=hyp['scale'],
                                             shear=hyp['shear'])
+                t = tick(self, 'affine', t)
 
             # Augment colorspace
             augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            t = tick(self, 'hsv', t)
 
             # Apply cutouts
             # if random.random() < 0.9:
@@ -478,6 +1051,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             # Normalize coordinates 0 - 1
             labels[:, [2, 4]] /= img.shape[0]  # height
             labels[:, [1, 3]] /= img.shape[1]  # width
+        t = tick(self, 'labels', t)
 
         if self.augment:
             # random left-right flip
@@ -493,67 +1067,939 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
                 img = np.flipud(img)
                 if nL:
                     labels[:, 2] = 1 - labels[:, 2]
+            tick(self, 'affine', t)
 
-        labels_out = torch.zeros((nL, 6))
-        if nL:
-            labels_out[:, 1:] = torch.from_numpy(labels)
-
-        # Convert
-        img = img[:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3x416x416
-        img = np.ascontiguousarray(img)
+        labels = labels if nL else np.zeros((0, 5), dtype=np.float32)
+        tick(self, 'sample', t0)
 
-        return torch.from_numpy(img), labels_out, img_path, shapes
+        # Image is returned as a (possibly flipped) HWC BGR view, converted only once when copied into the batch
+        return img, labels, img_path, shapes
 
-    @staticmethod
-    def collate_fn(batch):
+    def collate_fn(self, batch):
+        # Copies each HWC BGR image once, directly into its RGB CHW slot of a uint8 batch tensor allocated in shared
+        # memory (inside dataloader workers, as default_collate), and builds all targets with one concatenation
+        t = time.perf_counter()
         img, label, path, shapes = zip(*batch)  # transposed
-        for i, l in enumerate(label):
-            l[:, 0] = i  # add target image index for build_targets()
-        return torch.stack(img, 0), torch.cat(label, 0), path, shapes
+        h, w = img[0].shape[:2]
+        c = img[0].shape[2] if img[0].ndim == 3 else 1
+        imgs = shared_empty((len(img), c, h, w))
+        for i, x in enumerate(img):
+            np.copyto(imgs[i].numpy(), x[None] if c == 1 else x[:, :, ::-1].transpose(2, 0, 1))  # BGR to RGB, CHW
+
+        n = [len(l) for l in label]
+        targets = torch.zeros((sum(n), 6))
+        targets[:, 0] = torch.from_numpy(np.repeat(np.arange(len(n)), n))  # target image index for build_targets()
+        targets[:, 1:] = torch.from_numpy(np.concatenate(label, 0))
+        tick(self, 'collate', t)
+        return imgs, targets, path, shapes
+
+
+def shared_empty(shape):
+    # Returns an uninitialized uint8 tensor, allocated in shared memory inside dataloader workers so it is not copied again
+    # on its way to the main process
+    if torch.utils.data.get_worker_info() is None:
+        return torch.empty(shape, dtype=torch.uint8)
+    if hasattr(torch, 'UntypedStorage'):  # torch >= 2.0, allocate straight in shared memory as default_collate does
+        storage = torch.UntypedStorage._new_shared(int(np.prod(shape)))
+        return torch.empty(0, dtype=torch.uint8).set_(storage).view(shape)
+    return torch.empty(shape, dtype=torch.uint8).share_memory_()
+
+
+class AspectRatioBatchSampler(Sampler):  # shuffled rectangular batches for a rect=True LoadImagesAndLabels
+    # Groups images into aspect ratio buckets no wider than bucket_width (relative), then every epoch shuffles images
+    # within buckets and batches across buckets. Yields batches of (index, shape), shape the minimal letterboxed
+    # (height, width) of that batch, so all 640x512 FLIR frames i.e. train in 512x640 batches in random order
+    def __init__(self, dataset, batch_size, bucket_width=0.1, drop_last=False):
+        assert dataset.rect, 'AspectRatioBatchSampler requires a dataset with rect=True'
+        self.ar = dataset.ar  # aspect ratios h/w
+        self.img_size = dataset.img_size
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+        key = np.round(np.log(self.ar) / np.log(1 + bucket_width))
+        self.buckets = [np.flatnonzero(key == k) for k in np.unique(key)]
+
+    def __iter__(self):
+        batches = []
+        for b in self.buckets:
+            b = np.random.permutation(b)
+            batches += [b[i:i + self.batch_size] for i in range(0, len(b), self.batch_size)
+                        if not self.drop_last or i + self.batch_size <= len(b)]
+        random.shuffle(batches)
+        for b in batches:
+            shape = tuple(batch_shape(self.ar[b], self.img_size))
+            yield [(i, shape) for i in b.tolist()]
+
+    def __len__(self):
+        f = np.floor if self.drop_last else np.ceil
+        return int(sum(f(len(b) / self.batch_size) for b in self.buckets))
+
+
+class WeightedBatchSampler(Sampler):  # batches of indices drawn with replacement, weights read for every batch
+    # WeightedRandomSampler draws a whole epoch of indices on its first next(), which persistent workers request
+    # while prefetching the previous epoch, so updated weights would apply one epoch late. Here only the few batches
+    # already prefetched at an epoch boundary use the previous weights
+    def __init__(self, weights, batch_size, num_samples=None):
+        self.weights = torch.as_tensor(weights, dtype=torch.double)
+        self.batch_size = batch_size
+        self.num_samples = len(self.weights) if num_samples is None else num_samples
+
+    def __iter__(self):
+        for i in range(0, self.num_samples, self.batch_size):
+            n = min(self.batch_size, self.num_samples - i)
+            yield torch.multinomial(self.weights, n, replacement=True).tolist()
+
+    def __len__(self):
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+
+def loader_kwargs(workers, prefetch=2):
+    # Returns DataLoader worker kwargs, with prefetch_factor (batches loaded ahead per worker) where supported
+    kwargs = {'num_workers': workers}
+    if workers and 'prefetch_factor' in inspect.signature(torch.utils.data.DataLoader.__init__).parameters:
+        kwargs['prefetch_factor'] = prefetch  # torch >= 1.7
+    return kwargs
+
+
+def autotune_dataloader(dataset, batch_size, path, batches=30, warmup=5, batch_sampler=None):
+    # Returns the (workers, prefetch) giving the most samples/s from dataset, measured by a short calibration: worker
+    # counts are swept in powers of 2 up to the CPU count (stopping once past the peak), then prefetch depths at the
+    # best worker count. Results are saved per machine and configuration to a <list>.autotune.json file next to the
+    # image list, and later runs reuse them without calibrating. Pass the training batch_sampler, rect datasets need
+    # batches of one shape (without a batch_sampler they are measured in their fixed order)
+    file = os.path.splitext(str(Path(path)))[0] + '.autotune.json'
+    imgs = getattr(dataset, 'imgs', None)
+    cache = 'shards' if isinstance(dataset, LoadShards) else 'lru' if dataset.lru is not None else \
+        'disk' if isinstance(imgs, MmapImages) else 'shm' if isinstance(imgs, SharedImages) else \
+        'ram' if imgs[0] is not None else 'nocache'  # image cache mode
+    key = '%s %gcpu bs%g img%g %s %s %gch' % (platform.node(), os.cpu_count() or 1, batch_size, max(np.atleast_1d(
+        dataset.img_size)), 'train' if dataset.augment else 'test', cache, dataset.channels)
+    try:
+        with open(file, 'r') as f:
+            tuned = json.load(f)
+    except (OSError, ValueError):
+        tuned = {}
+    if key in tuned:
+        nw, pf, speed = tuned[key]
+        print('Dataloader autotune: %g workers, prefetch %g (%.1f samples/s, from %s)' % (nw, pf, speed, file))
+        return nw, pf
+
+    def measure(nw, pf):
+        if isinstance(dataset, LoadShards):
+            loader = shard_loader(dataset, batch_size, **loader_kwargs(nw, pf))
+        else:
+            kwargs = {'batch_sampler': batch_sampler} if batch_sampler is not None else \
+                {'batch_size': batch_size, 'shuffle': not dataset.rect}
+            loader = torch.utils.data.DataLoader(dataset, collate_fn=dataset.collate_fn, **kwargs,
+                                                 **loader_kwargs(nw, pf))
+        it = iter(loader)
+        nb = min(warmup + batches, len(loader))
+        for _ in range(min(warmup, nb - 1)):  # worker startup and first batches excluded
+            next(it)
+        n, t = 0, time.time()
+        for _ in range(nb - min(warmup, nb - 1)):
+            n += len(next(it)[0])
+        speed = n / (time.time() - t)
+        del it  # shut down workers
+        print('Dataloader autotune: %g workers, prefetch %g: %.1f samples/s' % (nw, pf, speed))
+        return speed
+
+    cpus = os.cpu_count() or 1
+    results = {}
+    for nw in sorted({0, cpus} | {2 ** i for i in range(1, 10) if 2 ** i < cpus}):
+        results[(nw, 2)] = measure(nw, 2)
+        if results[(nw, 2)] < 0.9 * max(results.values()):  # past the peak
+            break
+    nw = max(results, key=results.get)[0]
+    if nw:
+        for pf in 4, 8:
+            results[(nw, pf)] = measure(nw, pf)
+    (nw, pf), speed = max(results.items(), key=lambda x: x[1])
+
+    tuned[key] = [nw, pf, speed]
+    with open(file, 'w') as f:
+        json.dump(tuned, f, indent=2)
+    print('Dataloader autotune: using %g workers, prefetch %g (%.1f samples/s), saved to %s' % (nw, pf, speed, file))
+    return nw, pf
+
+
+class InfiniteDataLoader(torch.utils.data.dataloader.DataLoader):
+    # Dataloader whose workers persist for the whole run: every iter() continues one endless worker iterator for
+    # one pass of the batch sampler, so workers (and their copies of cached images) are never re-forked
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        object.__setattr__(self, 'batch_sampler', RepeatSampler(self.batch_sampler))
+        self.iterator = super().__iter__()
+
+    def __len__(self):
+        return len(self.batch_sampler.sampler)
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield next(self.iterator)
+
+
+class RepeatSampler:  # repeats a (batch) sampler forever
+    def __init__(self, sampler):
+        self.sampler = sampler
+
+    def __iter__(self):
+        while True:
+            yield from iter(self.sampler)
+
+
+class TrainTestLoaders:  # train and test loaders served by one persistent worker pool
+    # One InfiniteDataLoader over both datasets runs a batch sampler that alternates one train epoch with one test
+    # pass. Batches are prefetched across that boundary, so the train and test views must be consumed strictly in
+    # turn (train epoch, test pass, train epoch...), i.e. test every epoch
+    def __init__(self, dataset, testset, batch_sampler, batch_size_test, **kwargs):
+        test_sampler = torch.utils.data.BatchSampler(torch.utils.data.SequentialSampler(testset), batch_size_test,
+                                                     drop_last=False)
+        both = TrainTestDataset(dataset, testset)
+        self.loader = InfiniteDataLoader(both, batch_sampler=TrainTestBatchSampler(batch_sampler, test_sampler,
+                                                                                   len(dataset)),
+                                         collate_fn=both.collate_fn, **kwargs)
+        self.train = LoaderView(self.loader, dataset, len(batch_sampler))
+        self.test = LoaderView(self.loader, testset, len(test_sampler))
+
+
+class LoaderView:  # dataloader-like view of n batches at a time from a shared InfiniteDataLoader
+    def __init__(self, loader, dataset, n):
+        self.loader = loader
+        self.dataset = dataset
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        for _ in range(self.n):
+            yield next(self.loader.iterator)
+
+
+class TrainTestDataset(Dataset):  # train dataset indices first, then test dataset indices offset by len(train)
+    def __init__(self, dataset, testset):
+        self.dataset, self.testset = dataset, testset
+
+    def __len__(self):
+        return len(self.dataset) + len(self.testset)
+
+    def __getitem__(self, index):
+        i = index[0] if isinstance(index, tuple) else index  # (index, shape) from AspectRatioBatchSampler
+        return (self.dataset[index], False) if i < len(self.dataset) else (self.testset[i - len(self.dataset)], True)
+
+    def collate_fn(self, batch):
+        # Collates a batch with the collate_fn of the dataset it came from, so each is timed by its own StageTimer
+        batch, test = zip(*batch)
+        return (self.testset if test[0] else self.dataset).collate_fn(list(batch))
+
+
+class TrainTestBatchSampler(Sampler):  # one epoch of train batches followed by all test batches
+    def __init__(self, batch_sampler, test_sampler, offset):
+        self.batch_sampler, self.test_sampler, self.offset = batch_sampler, test_sampler, offset
+
+    def __len__(self):
+        return len(self.batch_sampler) + len(self.test_sampler)
+
+    def __iter__(self):
+        yield from self.batch_sampler
+        for b in self.test_sampler:
+            yield [i + self.offset for i in b]
+
+
+class LetterboxCache:  # test batches saved to a memory-mapped file on their first pass and streamed from it after
+    # Test batches have no augmentation, so after the first pass no image is decoded or letterboxed again. Images are
+    # appended to a temporary file in folder (one per run, deleted on exit) as one flat uint8 array, targets, paths
+    # and shapes of each batch are kept in memory
+    def __init__(self, loader, folder=None):
+        import tempfile
+        self.loader = loader
+        self.dataset = loader.dataset
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        fd, self.file = tempfile.mkstemp(suffix='.valcache', dir=folder)
+        os.close(fd)
+        self.index = None  # [(offset, shape, targets, paths, shapes)] per batch once a pass has completed
+        self.mm = None
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.index is None:  # first pass, save batches while yielding them
+            index, offset = [], 0
+            with open(self.file, 'wb') as f:
+                for imgs, targets, paths, shapes in self.loader:
+                    x = imgs.numpy()
+                    f.write(x.data)
+                    index.append((offset, x.shape, targets.numpy().copy(), paths, shapes))
+                    offset += x.nbytes
+                    yield imgs, targets, paths, shapes
+            self.index = index
+            self.mm = np.memmap(self.file, dtype=np.uint8, mode='c') if offset else None  # copy-on-write, never saved
+            print('Test batches cached in %s (%.1fGB)' % (self.file, offset / 1E9))
+        else:
+            for offset, shape, targets, paths, shapes in self.index:
+                imgs = np.ndarray(shape, dtype=np.uint8, buffer=self.mm, offset=offset)
+                yield torch.from_numpy(imgs), torch.from_numpy(targets), paths, shapes
+
+    def close(self):
+        self.mm = None
+        if os.path.exists(self.file):
+            os.remove(self.file)
+
+
+class MmapImages:  # read-only images memory-mapped from a *.imgcache file, see cache_images_disk()
+    def __init__(self, file, index):
+        self.file = file
+        self.index = index  # (offset, shape) per image
+        self.mm = None  # opened lazily, once per process
+        self.ino = None  # inode of the file first opened
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if self.mm is None:
+            self.open()
+        offset, shape = self.index[i]
+        return np.asarray(self.mm[offset:offset + int(np.prod(shape))]).reshape(shape)
+
+    def open(self):
+        # Maps the file, which must still be the one the index was built for (rewrites by other runs replace it)
+        ino = os.stat(self.file).st_ino
+        if self.ino is not None and ino != self.ino:
+            raise RuntimeError('%s was rewritten by another run, restart with a fresh cache' % self.file)
+        self.ino = ino
+        self.mm = np.memmap(self.file, dtype=np.uint8, mode='r')
+
+    def __getstate__(self):  # workers re-open the file instead of receiving a copy of its contents
+        return {'file': self.file, 'index': self.index, 'mm': None, 'ino': self.ino}
+
+
+@contextmanager
+def file_lock(path):
+    # Holds an exclusive lock on file path (created if needed) for the duration of a with block, no-op without fcntl
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class SharedImageCache:  # resized images of one or more datasets in a single shared-memory segment
+    # Usage: cache = SharedImageCache(); LoadImagesAndLabels(..., cache_images=cache) for each dataset; cache.build()
+    def __init__(self):
+        self.name = None  # shared memory segment name
+        self.shm = None
+        self.nbytes = 0  # bytes reserved
+        self.offsets = {}  # {(img_file, shape): offset}, images shared by several datasets are stored once
+        self.pending = []  # (dataset, index, offset, shape) to load on build()
+        self.bad = set()  # offsets of slots left unwritten, read back as not cached by every dataset sharing them
+        self.owner = False  # True in the process that created (and will unlink) the segment
+
+    def add(self, dataset):
+        # Reserves space for every image of dataset from its header size, returns imgs view, hw_original, hw_resized
+        index, hw0, hw = [], [], []
+        for i, (file, (w0, h0)) in enumerate(zip(dataset.img_files, dataset.shapes.astype(int).tolist())):
+            r = dataset.img_size / max(h0, w0)
+            h, w = (int(h0 * r), int(w0 * r)) if r < 1 or (dataset.augment and r != 1) else (h0, w0)  # as load_image
+            shape = (h, w) if dataset.channels == 1 else (h, w, 3)
+            key = (file, shape)
+            if key not in self.offsets:
+                self.offsets[key] = self.nbytes
+                self.pending.append((dataset, i, self.nbytes, shape))
+                self.nbytes += int(np.prod(shape))
+            index.append((self.offsets[key], shape))
+            hw0.append((h0, w0))
+            hw.append((h, w))
+        return SharedImages(self, index), hw0, hw
+
+    def build(self):
+        # Allocates the segment once for all added datasets and decodes every reserved image into it
+        from multiprocessing import shared_memory  # python >= 3.8
+        self.shm = shared_memory.SharedMemory(create=True, size=max(self.nbytes, 1))
+        self.name, self.owner = self.shm.name, True
+        atexit.register(self.close)
+        pbar = tqdm(self.pending, desc='Caching images in shared memory (%.1fGB)' % (self.nbytes / 1E9))
+        for dataset, i, offset, shape in pbar:
+            img = load_image(dataset, i)[0]
+            if img.shape != shape:  # header size disagrees with decoded image, leave uncached
+                self.bad.add(offset)
+                continue
+            np.ndarray(shape, dtype=np.uint8, buffer=self.shm.buf, offset=offset)[:] = img
+        self.pending = []
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+            self.shm = None
+
+    def __getstate__(self):  # attach by name in worker processes instead of copying the segment
+        return {'name': self.name, 'bad': self.bad}
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+        self.__init__()
+        self.name, self.bad = state['name'], state['bad']
+        if self.name is not None:  # dataloader workers share the owner's resource tracker, only the owner unlinks
+            self.shm = shared_memory.SharedMemory(name=self.name)
+
+
+class SharedImages:  # dataset.imgs view into a SharedImageCache, None for images not (yet) cached
+    def __init__(self, cache, index):
+        self.cache = cache
+        self.index = index  # (offset, shape) per image
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        offset, shape = self.index[i]
+        if self.cache.shm is None or self.cache.pending or offset in self.cache.bad:
+            return None
+        return np.ndarray(shape, dtype=np.uint8, buffer=self.cache.shm.buf, offset=offset)
+
+
+class ImageLRU:  # least recently used load_image() results up to max_bytes, one cache per dataloader worker process
+    def __init__(self, max_bytes=2E9, rows=65):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.cache = OrderedDict()  # {index: (img, hw_original, hw_resized)}
+        self.stats = torch.zeros((rows, 2), dtype=torch.int64).share_memory_()  # hits, misses per worker (row 0 main)
+        self.pid, self.row = None, 0
+
+    def get(self, index):
+        if self.pid != os.getpid():  # first call in this process
+            self.pid = os.getpid()
+            worker = torch.utils.data.get_worker_info()
+            self.row = (worker.id + 1) % len(self.stats) if worker else 0
+        x = self.cache.get(index)
+        if x is None:
+            self.stats[self.row, 1] += 1
+        else:
+            self.cache.move_to_end(index)
+            self.stats[self.row, 0] += 1
+        return x
+
+    def put(self, index, x):
+        nb = x[0].nbytes
+        if nb <= self.max_bytes:
+            self.cache[index] = x
+            self.nbytes += nb
+            while self.nbytes > self.max_bytes:  # evict least recently used
+                self.nbytes -= self.cache.popitem(last=False)[1][0].nbytes
+
+    def info(self):
+        # Returns a hit rate string summed over all workers, i.e. ' cache 87% hit (1.2e+04/1.4e+04)'
+        hits, misses = self.stats.sum(0).tolist()
+        return ' cache %.0f%% hit (%.3g/%.3g)' % (100 * hits / max(hits + misses, 1), hits, hits + misses)
+
+
+class AugmentRing:  # fully augmented training batches produced ahead by background processes into a ring of slots
+    # Producers take free slots, write an augmented batch (uint8 images, float32 targets) into the ring, in shared
+    # memory or in an on-disk file, and queue it as ready. The trainer iterates the ring like a dataloader. If no new
+    # batch is ready, the last batch is served again up to reuse times in total before waiting for producers.
+    # Yielded images point into the ring and are only valid until the next batch is requested.
+    def __init__(self, dataset, batch_size, slots=16, workers=2, reuse=1, file='', max_targets=300):
+        import multiprocessing as mp
+        assert isinstance(dataset, LoadImagesAndLabels) and dataset.augment and not dataset.rect and \
+               not dataset.image_weights, 'AugmentRing requires a square augmented dataset without image weights'
+        self.n = len(dataset) // batch_size  # batches per epoch
+        self.reuse = max(reuse, 1)
+        s, c = dataset.img_size, dataset.channels
+        self.img_shape = (batch_size, c, s, s)
+        self.target_shape = (batch_size * max_targets, 6)
+        self.slot_bytes = int(np.prod(self.img_shape)) + int(np.prod(self.target_shape)) * 4
+        self.slots = max(slots, workers + 2)
+        nbytes = self.slots * self.slot_bytes
+
+        self.shm, self.file = None, file
+        if file:  # on-disk ring
+            self.buf = np.memmap(file, dtype=np.uint8, mode='w+', shape=(nbytes,))
+            spec = ('file', file, nbytes)
+        else:  # shared-memory ring
+            from multiprocessing import shared_memory  # python >= 3.8
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+            self.buf = np.ndarray((nbytes,), dtype=np.uint8, buffer=self.shm.buf)
+            spec = ('shm', self.shm.name, nbytes)
+
+        self.free_q, self.ready_q = mp.Queue(), mp.Queue()
+        for i in range(self.slots):
+            self.free_q.put(i)
+        seed = int.from_bytes(os.urandom(4), 'little')  # per run, init_seeds() fixes torch and numpy seeds to 0
+        self.producers = [mp.Process(target=augment_producer, daemon=True,
+                                     args=(dataset, batch_size, spec, self, self.free_q, self.ready_q,
+                                           (seed + i) % 2 ** 32))
+                          for i in range(workers)]
+        for p in self.producers:
+            p.start()
+        self.served, self.reused = 0, 0
+        atexit.register(self.close)
+
+    def __getstate__(self):  # producers only need the slot layout
+        return {k: self.__dict__[k] for k in ('img_shape', 'target_shape', 'slot_bytes')}
+
+    def slot(self, buf, i):
+        # Returns the (images, targets) arrays of slot i in ring buffer buf
+        o = i * self.slot_bytes
+        imgs = np.ndarray(self.img_shape, dtype=np.uint8, buffer=buf, offset=o)
+        targets = np.ndarray(self.target_shape, dtype=np.float32, buffer=buf, offset=o + imgs.nbytes)
+        return imgs, targets
+
+    def __len__(self):
+        return self.n
+
+    def ready(self, block):
+        # Returns the next ready (slot, number of targets, paths), None if not blocking and no batch is ready. Raises
+        # the error of a failed producer, or if every producer has exited while waiting
+        import queue
+        while True:
+            try:
+                x = self.ready_q.get(block=block, timeout=10 if block else None)
+            except queue.Empty:
+                if not block:
+                    return None
+                exitcodes = [p.exitcode for p in self.producers]
+                if None not in exitcodes:  # none alive, i.e. killed by the OOM killer
+                    raise RuntimeError('AugmentRing producers exited with codes %s' % exitcodes)
+                continue
+            if isinstance(x, str):  # traceback of a failed producer
+                raise RuntimeError('AugmentRing producer failed:\n%s' % x)
+            return x
+
+    def __iter__(self):
+        held, uses = None, 0  # (slot, number of targets, paths) of the batch last served, times served
+        for _ in range(self.n):
+            x = self.ready(block=held is None or uses >= self.reuse)  # None: producers behind, serve held again
+            if x is not None:
+                if held is not None:
+                    self.free_q.put(held[0])
+                held, uses = x, 0
+            else:
+                self.reused += 1
+            uses += 1
+            self.served += 1
+            i, nt, paths = held
+            imgs, targets = self.slot(self.buf, i)
+            yield torch.from_numpy(imgs), torch.from_numpy(targets[:nt].copy()), paths, None
+        if held is not None:
+            self.free_q.put(held[0])
+
+    def info(self):
+        # Returns the share of batches served more than once, i.e. ' ring 12% reused'
+        return ' ring %.0f%% reused' % (100 * self.reused / max(self.served, 1))
+
+    def close(self):
+        for p in self.producers:
+            p.terminate()
+        self.producers = []
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+def augment_producer(dataset, batch_size, spec, ring, free_q, ready_q, seed):
+    # AugmentRing producer process: writes augmented batches of randomly ordered images into free ring slots
+    kind, name, nbytes = spec
+    if kind == 'file':
+        buf = np.memmap(name, dtype=np.uint8, mode='r+', shape=(nbytes,))
+    else:
+        from multiprocessing import shared_memory
+        shm = shared_memory.SharedMemory(name=name)  # registered with the trainer's resource tracker, it unlinks
+        buf = np.ndarray((nbytes,), dtype=np.uint8, buffer=shm.buf)
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.set_num_threads(1)
+
+    order, j = np.random.permutation(len(dataset)), 0
+    try:
+        while True:
+            i = free_q.get()
+            if j + batch_size > len(order):  # new epoch order
+                order, j = np.random.permutation(len(dataset)), 0
+            imgs, targets, paths, _ = dataset.collate_fn([dataset[k] for k in order[j:j + batch_size]])
+            j += batch_size
+            slot_imgs, slot_targets = ring.slot(buf, i)
+            slot_imgs[:] = imgs.numpy()
+            nt = min(len(targets), len(slot_targets))  # targets beyond batch_size * max_targets are dropped
+            slot_targets[:nt] = targets[:nt].numpy()
+            ready_q.put((i, nt, paths))
+    except Exception:
+        import traceback
+        ready_q.put(traceback.format_exc())  # raised again by the trainer, see AugmentRing.ready()
+
+
+class StageTimer:  # seconds and calls per loading stage of a dataset, summed over all dataloader worker processes
+    # Usage: dataset.timer = StageTimer() before creating dataloaders; timer.info() and timer.reset() every epoch.
+    # Stages run a different number of times per sample (4 decodes per mosaic, collate once per batch), so they are
+    # reported per sample, 'sample' being a whole __getitem__ call
+    stages = ('decode', 'mosaic', 'letterbox', 'affine', 'hsv', 'labels', 'collate', 'sample')
+
+    def __init__(self, rows=65):
+        self.index = {k: i for i, k in enumerate(self.stages)}
+        self.stats = torch.zeros((rows, len(self.stages), 2), dtype=torch.float64).share_memory_()  # row per worker
+        self.pid, self.row, self.a = None, None, None
+
+    def add(self, stage, t0):
+        # Adds the time since t0 to stage, returns the current time
+        t = time.perf_counter()
+        if self.pid != os.getpid():  # first call in this process
+            self.pid = os.getpid()
+            worker = torch.utils.data.get_worker_info()
+            self.row = (worker.id + 1) % len(self.stats) if worker else 0
+            self.a = self.stats.numpy()  # shared memory view, much faster to update than the tensor
+        a = self.a[self.row, self.index[stage]]
+        a[0] += t - t0
+        a[1] += 1
+        return t
+
+    def times(self):
+        # Returns {stage: (total seconds, calls)} summed over workers
+        return {k: tuple(x) for k, x in zip(self.stages, self.stats.sum(0).tolist())}
+
+    def per_sample(self):
+        # Returns {stage: ms per sample} summed over workers
+        times = self.times()
+        n = max(times['sample'][1], 1)
+        return {k: 1E3 * s / n for k, (s, _) in times.items()}
+
+    def info(self):
+        # Returns a per-stage ms per sample string, i.e. 'decode 4.1ms, mosaic 2.3ms, ...'
+        return ', '.join('%s %.3gms' % x for x in self.per_sample().items())
+
+    def reset(self):
+        self.stats.zero_()
+
+    def __getstate__(self):  # stats tensor is shared, every worker process finds its own row
+        return {'index': self.index, 'stats': self.stats, 'pid': None, 'row': None, 'a': None}
+
+
+def tick(self, stage, t):
+    # Adds the time since t to a loading stage of dataset self if it is being timed, returns the current time
+    return self.timer.add(stage, t) if self.timer is not None else t
+
+
+class LoadShards(IterableDataset):  # for streaming training/testing from packed shards, see create_shards()
+    def __init__(self, path, img_size=416, batch_size=16, augment=False, hyp=None, single_cls=False, channels=3,
+                 buffer_size=64):
+        path = str(Path(path))  # os-agnostic
+        assert os.path.isfile(path), 'File not found %s. See %s' % (path, help_url)
+        index = np.load(path, allow_pickle=True).item()  # {'shards', 'counts', 'img_files', 'labels'}
+        self.shards = [os.path.join(os.path.dirname(path), x) for x in index['shards']]
+        self.counts = index['counts']  # images per shard
+        self.img_files = index['img_files']
+        self.labels = index['labels']  # all labels, i.e. for class weights
+        if single_cls:
+            self.labels = [np.concatenate((np.zeros_like(x[:, :1]), x[:, 1:]), 1) for x in self.labels]
+        self.n = len(self.img_files)
+        assert self.n > 0, 'No images found in %s. See %s' % (path, help_url)
+
+        self.img_size = img_size
+        self.augment = augment
+        self.hyp = hyp
+        self.single_cls = single_cls
+        self.channels = channels
+        self.buffer_size = buffer_size if augment else 1  # shuffle buffer (and mosaic partners) per worker, encoded
+        self.batch_size = batch_size
+        self.workers = 0  # dataloader workers, set by shard_loader()
+        self.image_weights = False
+        self.lru = None
+        self.timer = None
+
+    def __len__(self):
+        # Batches per epoch, every worker yields its own last partial batch
+        w = max(self.workers, 1)
+        return sum(math.ceil(sum(self.counts[i::w]) / self.batch_size) for i in range(w))
+
+    def __iter__(self):
+        # Yields batches collated in the worker that loaded them, see shard_loader()
+        batch = []
+        for x in self.samples():
+            batch.append(x)
+            if len(batch) == self.batch_size:
+                yield self.collate_fn(batch)
+                batch = []
+        if batch:
+            yield self.collate_fn(batch)
+
+    def samples(self):
+        # Each worker streams its own subset of shards, shuffled per epoch, through a shuffle buffer
+        worker = torch.utils.data.get_worker_info()
+        shards = self.shards[worker.id::worker.num_workers] if worker else list(self.shards)
+        if self.augment:
+            random.shuffle(shards)
+
+        buffer = ShardBuffer(self)
+        for path, data, labels, hw0 in read_shards(shards):
+            buffer.append(path, data, labels, hw0)
+            if len(buffer) >= self.buffer_size:
+                yield buffer.pop(random.randrange(len(buffer)) if self.augment else 0)
+        while len(buffer):
+            yield buffer.pop(random.randrange(len(buffer)) if self.augment else 0)
+
+    collate_fn = LoadImagesAndLabels.collate_fn
+
+
+def shard_loader(dataset, batch_size, **kwargs):
+    # Returns a DataLoader of LoadShards batches of batch_size, len() exact for the number of workers in kwargs
+    dataset.batch_size, dataset.workers = batch_size, kwargs.get('num_workers', 0)
+    return torch.utils.data.DataLoader(dataset, batch_size=None, collate_fn=uncollated, **kwargs)
+
+
+def uncollated(batch):  # collate_fn of datasets yielding whole batches
+    return batch
+
+
+class ShardBuffer:  # shuffle buffer of encoded shard images, indexed like a LoadImagesAndLabels dataset
+    def __init__(self, dataset):
+        self.img_size = dataset.img_size
+        self.augment = dataset.augment
+        self.hyp = dataset.hyp
+        self.single_cls = dataset.single_cls
+        self.channels = dataset.channels
+        self.rect = self.image_weights = False
+        self.lru = None
+        self.timer = dataset.timer
+        self.img_files, self.data, self.img_hw0, self.labels = [], [], [], []
+        self.imgs = ShardImages(self)  # decoded when loaded, only encoded bytes are buffered
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, path, data, labels, hw0):
+        if self.single_cls and len(labels):
+            labels[:, 0] = 0
+        for x, v in zip((self.img_files, self.data, self.img_hw0, self.labels), (path, data, hw0, labels)):
+            x.append(v)
+
+    def pop(self, i):
+        # Returns augmented/letterboxed sample i (mosaic partners are drawn from the buffer) and removes it
+        sample = LoadImagesAndLabels.__getitem__(self, i)
+        for x in (self.img_files, self.data, self.img_hw0, self.labels):
+            x[i] = x[-1]
+            x.pop()
+        return sample
+
+
+class ShardImages:  # ShardBuffer.imgs view decoding and resizing buffered images on access, as load_image()
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def __getitem__(self, i):
+        b = self.buffer
+        path, (h0, w0) = b.img_files[i], b.img_hw0[i]
+        img, (h0, w0) = imread_reduced(path, b.img_size, b.channels, (w0, h0), buf=b.data[i])  # packed hw checked
+        assert img is not None, 'Image Not Decoded %s' % path
+        b.img_hw0[i] = (h0, w0)  # as decoded, read by load_image()
+        return resize_image(b, img, h0, w0)
+
+
+# Shard record layout (little-endian), records are written back to back until the end of each *.shard file:
+#   uint32 path_len, uint32 img_len, uint32 n_labels, uint16 height, uint16 width  (16-byte header)
+#   path_len bytes   image path (utf-8)
+#   n_labels x 5     float32 labels [class, xywh normalized]
+#   img_len bytes    original image file bytes (i.e. JPEG)
+shard_header = struct.Struct('<IIIHH')
+
+
+def read_shards(shards):
+    # Yields (path, encoded image bytes, labels, original hw) from shard files, read sequentially with large buffers
+    for shard in shards:
+        with open(shard, 'rb', buffering=1 << 22) as f:
+            while True:
+                header = f.read(shard_header.size)
+                if len(header) < shard_header.size:
+                    break
+                np_, ni, nl, h, w = shard_header.unpack(header)
+                path = f.read(np_).decode()
+                labels = np.frombuffer(f.read(nl * 20), dtype=np.float32).reshape(nl, 5).copy()
+                yield path, f.read(ni), labels, (h, w)
+
+
+def create_shards(path='data/FLIR_Train.txt', shard_size=1000, shuffle=True):  # from utils.datasets import *; create_shards()
+    # Packs the images and labels of an image list into sequential *.shard files (in the <list>_shards folder) and
+    # writes a <list>.shards index, which can replace the list path in *.data files for streaming with LoadShards
+    dataset = LoadImagesAndLabels(path, cache_labels=True)
+    n = dataset.n
+    order = np.random.permutation(n) if shuffle else np.arange(n)  # pack in random order for better shuffling
+    shapes = dataset.shapes.astype(int).tolist()
+    base = os.path.splitext(str(Path(path)))[0]
+    folder = base + '_shards'
+    create_folder(folder)
+
+    index = {'shards': [], 'counts': [], 'img_files': [], 'labels': []}
+    for i in tqdm(range(0, n, shard_size), desc='Writing shards to %s' % folder):
+        name = '%05g.shard' % (i // shard_size)
+        with open(os.path.join(folder, name), 'wb', buffering=1 << 22) as f:
+            for j in order[i:i + shard_size]:
+                file = dataset.img_files[j]
+                with open(file, 'rb') as fi:
+                    b = fi.read()
+                p = file.encode()
+                l = np.asarray(dataset.labels[j], dtype=np.float32).reshape(-1, 5)
+                w, h = shapes[j]
+                f.write(shard_header.pack(len(p), len(b), len(l), h, w))
+                f.write(p)
+                f.write(l.tobytes())
+                f.write(b)
+                index['img_files'].append(file)
+                index['labels'].append(l)
+        index['shards'].append(os.path.join(Path(folder).name, name))
+        index['counts'].append(len(order[i:i + shard_size]))
+
+    with open(base + '.shards', 'wb') as f:
+        np.save(f, index)
+    print('Packed %g images into %g shards, index %s' % (n, len(index['shards']), base + '.shards'))
 
 
 def load_image(self, index):
     # loads 1 image from dataset, returns img, original hw, resized hw
     img = self.imgs[index]
+    if img is None and self.lru is not None:  # not cached, try worker LRU cache
+        x = self.lru.get(index)
+        if x is not None:
+            return x
     if img is None:  # not cached
         img_path = self.img_files[index]
-        img = cv2.imread(img_path)  # BGR
+        shape = self.shapes[index]  # orig wh from the shapefile or manifest, only picks the JPEG decoding scale
+        img, (h0, w0) = imread_reduced(img_path, self.img_size, self.channels, shape)  # BGR or gray, orig hw
         assert img is not None, 'Image Not Found ' + img_path
-        h0, w0 = img.shape[:2]  # orig hw
-        r = self.img_size / max(h0, w0)  # resize image to img_size
-        if r < 1 or (self.augment and (r != 1)):  # always resize down, only resize up if training with augmentation
-            interp = cv2.INTER_AREA if self.augment else cv2.INTER_AREA  # LINEAR for training, AREA for testing
-            img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        img = resize_image(self, img, h0, w0)
+        if self.lru is not None:
+            self.lru.put(index, (img, (h0, w0), img.shape[:2]))
         return img, (h0, w0), img.shape[:2]  # img, hw_original, hw_resized
     else:
-        return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
+        return img, self.img_hw0[index], img.shape[:2]  # img, hw_original, hw_resized
+
+
+def is_jpeg(path):
+    return os.path.splitext(path)[-1].lower() in ('.jpg', '.jpeg')
+
+
+def reduced_flags(shape, img_size, channels=3):
+    # Returns cv2.imread() flags decoding an image of original (w, h) shape at the smallest 1/2, 1/4 or 1/8 scale
+    # whose long side is still at least img_size. libjpeg scales JPEGs during decoding, skipping most of the work
+    s = max(img_size) if isinstance(img_size, (tuple, list)) else img_size
+    f = max(shape) // s  # largest allowed reduction
+    for k, gray, color in ((8, cv2.IMREAD_REDUCED_GRAYSCALE_8, cv2.IMREAD_REDUCED_COLOR_8),
+                           (4, cv2.IMREAD_REDUCED_GRAYSCALE_4, cv2.IMREAD_REDUCED_COLOR_4),
+                           (2, cv2.IMREAD_REDUCED_GRAYSCALE_2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if f >= k:
+            return gray if channels == 1 else color
+    return cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+
+
+reduced_scales = {cv2.IMREAD_REDUCED_GRAYSCALE_2: 2, cv2.IMREAD_REDUCED_COLOR_2: 2,
+                  cv2.IMREAD_REDUCED_GRAYSCALE_4: 4, cv2.IMREAD_REDUCED_COLOR_4: 4,
+                  cv2.IMREAD_REDUCED_GRAYSCALE_8: 8, cv2.IMREAD_REDUCED_COLOR_8: 8}  # reduced_flags() scales
+
+
+def imread_reduced(path, img_size, channels=3, shape=None, buf=None):
+    # Reads a BGR (or grayscale) image (decodes buf instead if given, the encoded bytes of path), decoding JPEGs at a
+    # reduced scale if at least 2x img_size. The original (w, h) shape, read from the file header if not given, only
+    # picks the scale: a reduced image whose size disagrees with it (i.e. file replaced since the shape was read) is
+    # decoded again in full. Returns img (None if not read), original hw of the decoded image
+    flags = full = cv2.IMREAD_GRAYSCALE if channels == 1 else cv2.IMREAD_COLOR
+    if is_jpeg(path):
+        try:
+            if shape is None:
+                with Image.open(path) as img:  # header only
+                    shape = exif_size(img)
+            flags = reduced_flags(shape, img_size, channels)
+        except Exception:
+            pass  # let cv2 decide
+
+    def read(flags):
+        return cv2.imread(path, flags) if buf is None else cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags)
+
+    img = read(flags)
+    k = reduced_scales.get(flags, 1)
+    if k > 1:
+        w0, h0 = int(shape[0]), int(shape[1])
+        if img is not None and img.shape[:2] == (-(-h0 // k), -(-w0 // k)):  # libjpeg rounds reduced sizes up
+            return img, (h0, w0)
+        img = read(full)
+    if img is None:
+        return None, (0, 0)
+    return img, img.shape[:2]
+
+
+def resize_image(self, img, h0, w0):
+    # Resizes img (original hw h0, w0, possibly decoded reduced) to img_size of dataset self, as loaded for training
+    r = self.img_size / max(h0, w0)  # resize image to img_size
+    if r < 1 or (self.augment and (r != 1)):  # always resize down, only resize up if training with augmentation
+        interp = cv2.INTER_AREA if self.augment else cv2.INTER_AREA  # LINEAR for training, AREA for testing
+        img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+    return img
+
+
+def load_labels(self, index):
+    # loads labels [class, xywh normalized] of 1 image from dataset, returns None if its label file is missing
+    x = self.labels[index]
+    if x is None:  # labels not preloaded
+        label_path = self.label_files[index]
+        if not os.path.isfile(label_path):
+            return None
+        with open(label_path, 'r') as f:
+            x = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
+    return x
 
 
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     # Old version
     #x = (np.random.uniform(-1, 1, 3) * np.array([hgain, sgain, vgain]) + 1).astype(np.float32)  # random gains
     #img_hsv = (cv2.cvtColor(img, cv2.COLOR_BGR2HSV) * x.reshape((1, 1, 3))).clip(None, 255).astype(np.uint8)
-    # New Version for HSV
+    # New Version for HSV, gains applied in place through 256-entry lookup tables (same uint8 result as multiplying
+    # in float, clipping and truncating, without any full-size float temporaries)
     x = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1  # random gains
-    img_hsv = (cv2.cvtColor(img, cv2.COLOR_BGR2HSV) * x).clip(None, 255).astype(np.uint8)
-    np.clip(img_hsv[:, :, 0], None, 179, out=img_hsv[:, :, 0])  # inplace hue clip (0 - 179 deg)
+    lut = (np.arange(256).reshape(256, 1) * x).clip(None, 255).astype(np.uint8)  # 256x3 hue, sat, val tables
+    np.clip(lut[:, 0], None, 179, out=lut[:, 0])  # hue clip (0 - 179 deg)
+    if img.ndim == 2:  # grayscale, hue and saturation are 0 so only the value gain applies
+        cv2.LUT(img, lut[:, 2].copy(), dst=img)
+        return
+    img_hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    cv2.LUT(img_hsv, lut.reshape(256, 1, 3), dst=img_hsv)
     cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)  # no return needed
 
 
 def load_mosaic(self, index):
     # loads images in a mosaic
 
+    # Each tile is warped straight from its place in a virtual 2s x 2s mosaic into the s x s output by one
+    # affine transform, the mosaic canvas itself is never allocated
     labels4 = []
     s = self.img_size
     xc, yc = [int(random.uniform(s * 0.5, s * 1.5)) for _ in range(2)]  # mosaic center x, y
-    img4 = np.zeros((s * 2, s * 2, 3), dtype=np.uint8) + 128  # base image with 4 tiles
     indices = [index] + [random.randint(0, len(self.labels) - 1) for _ in range(3)]  # 3 additional image indices
+    t = time.perf_counter()
+    M, (width, height) = random_affine_matrix((s * 2, s * 2),
+                                              degrees=self.hyp['degrees'] * 1,
+                                              translate=self.hyp['translate'] * 1,
+                                              scale=self.hyp['scale'] * 1,
+                                              shear=self.hyp['shear'] * 1,
+                                              border=-s // 2)  # border to remove
+    t = tick(self, 'affine', t)
     for i, index in enumerate(indices):
         # Load image
         img, _, (h, w) = load_image(self, index)
+        t = tick(self, 'decode', t)
 
         # place img in img4
         if i == 0:  # top left
+            img4 = np.full((height, width) + img.shape[2:], 128, dtype=np.uint8)  # output image
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -566,18 +2012,15 @@ def load_mosaic(self, index):
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
         padw = x1a - x1b
         padh = y1a - y1b
+        t = tick(self, 'mosaic', t)
+        warp_tile(img[y1b:y2b, x1b:x2b], M, x1a, y1a, img4)  # mosaic[ymin:ymax, xmin:xmax] warped into img4
+        t = tick(self, 'affine', t)
 
         # Load labels
-        label_path = self.label_files[index]
-        if os.path.isfile(label_path):
-            x = self.labels[index]
-            if x is None:  # labels not preloaded
-                with open(label_path, 'r') as f:
-                    x = np.array([x.split() for x in f.read().splitlines()], dtype=np.float32)
-
+        x = load_labels(self, index)
+        if x is not None:
             if x.size > 0:
                 # Normalized xywh to pixel xyxy format
                 labels = x.copy()
@@ -588,6 +2031,7 @@ def load_mosaic(self, index):
             else:
                 labels = np.zeros((0, 5), dtype=np.float32)
             labels4.append(labels)
+        t = tick(self, 'labels', t)
 
     # Concat/clip labels
     if len(labels4):
@@ -595,14 +2039,9 @@ def load_mosaic(self, index):
         # np.clip(labels4[:, 1:] - s / 2, 0, s, out=labels4[:, 1:])  # use with center crop
         np.clip(labels4[:, 1:], 0, 2 * s, out=labels4[:, 1:])  # use with random_affine
 
-    # Augment
-    # img4 = img4[s // 2: int(s * 1.5), s // 2:int(s * 1.5)]  # center crop (WARNING, requires box pruning)
-    img4, labels4 = random_affine(img4, labels4,
-                                  degrees=self.hyp['degrees'] * 1,
-                                  translate=self.hyp['translate'] * 1,
-                                  scale=self.hyp['scale'] * 1,
-                                  shear=self.hyp['shear'] * 1,
-                                  border=-s // 2)  # border to remove
+    # Augment labels (image already warped)
+    labels4 = affine_targets(labels4, M, width, height)
+    tick(self, 'labels', t)
 
     return img4, labels4
 
@@ -641,26 +2080,47 @@ def letterbox(img, new_shape=(640, 512), color=(128, 128, 128),
     return img, ratio, (dw, dh)
 
 
+def batch_shape(ar, img_size, stride=32):
+    # Returns the minimal letterboxed (height, width), a multiple of stride, for a batch of aspect ratios h/w
+    mini, maxi = ar.min(), ar.max()
+    s = [1, 1]
+    if maxi < 1:
+        s = [maxi, 1]
+    elif mini > 1:
+        s = [1, 1 / mini]
+    return np.ceil(np.array(s) * img_size / stride).astype(np.int) * stride
+
+
 def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10, border=0):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
     # https://medium.com/uruvideo/dataset-augmentation-with-random-homographies-a8f4b44830d4
 
     if targets is None:  # targets = [cls, xyxy]
         targets = []
-    height = img.shape[0] + border * 2
-    width = img.shape[1] + border * 2
+    M, (width, height) = random_affine_matrix(img.shape[:2], degrees, translate, scale, shear, border)
+    changed = (border != 0) or (M != np.eye(3)).any()
+    if changed:
+        img = cv2.warpAffine(img, M[:2], dsize=(width, height), flags=cv2.INTER_AREA, borderValue=(128, 128, 128))
+
+    return img, affine_targets(targets, M, width, height)
+
+
+def random_affine_matrix(shape, degrees=10, translate=.1, scale=.1, shear=10, border=0):
+    # Returns a random 3x3 affine matrix for an image of shape (h, w) and the (width, height) of its warped output
+    height = shape[0] + border * 2
+    width = shape[1] + border * 2
 
     # Rotation and Scale
     R = np.eye(3)
     a = random.uniform(-degrees, degrees)
     # a += random.choice([-180, -90, 0, 90])  # add 90deg rotations to small rotations
     s = random.uniform(1 - scale, 1 + scale)
-    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(img.shape[1] / 2, img.shape[0] / 2), scale=s)
+    R[:2] = cv2.getRotationMatrix2D(angle=a, center=(shape[1] / 2, shape[0] / 2), scale=s)
 
     # Translation
     T = np.eye(3)
-    T[0, 2] = random.uniform(-translate, translate) * img.shape[0] + border  # x translation (pixels)
-    T[1, 2] = random.uniform(-translate, translate) * img.shape[1] + border  # y translation (pixels)
+    T[0, 2] = random.uniform(-translate, translate) * shape[0] + border  # x translation (pixels)
+    T[1, 2] = random.uniform(-translate, translate) * shape[1] + border  # y translation (pixels)
 
     # Shear
     S = np.eye(3)
@@ -668,11 +2128,11 @@ def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10,
     S[1, 0] = math.tan(random.uniform(-shear, shear) * math.pi / 180)  # y shear (deg)
 
     # Combined rotation matrix
-    M = S @ T @ R  # ORDER IS IMPORTANT HERE!!
-    changed = (border != 0) or (M != np.eye(3)).any()
-    if changed:
-        img = cv2.warpAffine(img, M[:2], dsize=(width, height), flags=cv2.INTER_AREA, borderValue=(128, 128, 128))
+    return S @ T @ R, (width, height)  # ORDER IS IMPORTANT HERE!!
 
+
+def affine_targets(targets, M, width, height):
+    # Transforms targets [cls, xyxy] by affine matrix M, rejecting boxes mostly outside of the width x height output
     # Transform label coordinates
     n = len(targets)
     if n:
@@ -708,7 +2168,29 @@ def random_affine(img, targets=(), degrees=10, translate=.1, scale=.1, shear=10,
         targets = targets[i]
         targets[:, 1:5] = xy[i]
 
-    return img, targets
+    return targets
+
+
+def warp_tile(tile, M, x, y, out):
+    # Warps tile, placed at (x, y) of a source canvas, into out by the canvas-to-out affine matrix M. Only the region
+    # of out covered by the tile is computed and written, the rest of out is left unchanged
+    th, tw = tile.shape[:2]
+    if not th or not tw:
+        return
+    # Bilinear remap skips out pixels whose source falls in the last row/column of the tile, pad by one replicated
+    # pixel so the seams between neighbouring tiles are covered as they were on the continuous canvas
+    tile = cv2.copyMakeBorder(tile, 1, 1, 1, 1, cv2.BORDER_REPLICATE)
+    th, tw = th + 2, tw + 2
+    Mt = M @ np.array([[1, 0, x - 1], [0, 1, y - 1], [0, 0, 1]], dtype=np.float64)  # tile to out
+    c = np.array([[0, 0, 1], [tw, 0, 1], [0, th, 1], [tw, th, 1]]) @ Mt[:2].T  # tile corners in out
+    x0, y0 = map(int, np.clip(np.floor(c.min(0)), 0, None))
+    x1, y1 = map(int, np.minimum(np.ceil(c.max(0)), (out.shape[1], out.shape[0])))
+    if x1 > x0 and y1 > y0:
+        Mt[:2, 2] -= (x0, y0)
+        roi = out[y0:y1, x0:x1]
+        r = cv2.warpAffine(tile, Mt[:2], dsize=(x1 - x0, y1 - y0), dst=roi, flags=cv2.INTER_AREA,
+                           borderMode=cv2.BORDER_TRANSPARENT)
+        assert r is roi, 'warp_tile requires out to be warped in place'  # a new dst would hold garbage outside the tile
 
 
 def cutout(image, labels):
@@ -760,6 +2242,35 @@ def cutout(image, labels):
     return labels
 
 
+def benchmark_augment_hsv(shape=(512, 640, 3), n=200):  # from utils.datasets import *; benchmark_augment_hsv()
+    # Times augment_hsv() against the float multiply version it replaced on random 640x512 frames, and checks both
+    # give identical images for the same random gains
+    def augment_hsv_float(img, hgain=0.5, sgain=0.5, vgain=0.5):
+        x = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1  # random gains
+        if img.ndim == 2:
+            img[:] = (img * x[2]).clip(None, 255).astype(np.uint8)
+            return
+        img_hsv = (cv2.cvtColor(img, cv2.COLOR_BGR2HSV) * x).clip(None, 255).astype(np.uint8)
+        np.clip(img_hsv[:, :, 0], None, 179, out=img_hsv[:, :, 0])  # inplace hue clip (0 - 179 deg)
+        cv2.cvtColor(img_hsv, cv2.COLOR_HSV2BGR, dst=img)
+
+    img0 = np.random.randint(0, 256, shape, dtype=np.uint8)
+    for i in range(10):  # same gains must give the same image
+        a, b = img0.copy(), img0.copy()
+        np.random.seed(i)
+        augment_hsv_float(a)
+        np.random.seed(i)
+        augment_hsv(b)
+        assert np.array_equal(a, b), 'augment_hsv() differs from the float version'
+
+    for f in (augment_hsv_float, augment_hsv):
+        img = img0.copy()
+        t = time.time()
+        for _ in range(n):
+            f(img)
+        print('%s: %.3fms per %gx%g image' % (f.__name__, (time.time() - t) / n * 1E3, shape[1], shape[0]))
+
+
 def reduce_img_size(path='../data/sm4/images', img_size=640):  # from utils.datasets import *; reduce_img_size()
     # creates a new ./images_reduced folder with reduced size images of maximum size img_size
     path_new = path + '_reduced'  # reduced images path
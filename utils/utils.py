@@ -1,8 +1,12 @@
 import glob
+import json
 import math
 import os
+import queue
 import random
 import shutil
+import threading
+import time
 from pathlib import Path
 
 import cv2
@@ -62,11 +66,19 @@ def labels_to_class_weights(labels, nc=80):
     return torch.from_numpy(weights)
 
 
+def labels_to_class_counts(labels, nc=80):
+    # Returns the (images, classes) matrix of label counts, built with a single bincount. Dense, as nc is small
+    # (FLIR nc = 3, so 3 ints per image) and a sparse matrix would only add a scipy dependency
+    n = np.array([len(x) for x in labels])
+    classes = np.concatenate(labels, 0)[:, 0].astype(np.int) if n.sum() else np.zeros(0, dtype=np.int)
+    i = np.repeat(np.arange(len(labels)), n)  # image index of each label
+    return np.bincount(i * nc + classes, minlength=len(labels) * nc).reshape(len(labels), nc)
+
+
 def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
-    # Produces image weights based on class mAPs
-    n = len(labels)
-    class_counts = np.array([np.bincount(labels[i][:, 0].astype(np.int), minlength=nc) for i in range(n)])
-    image_weights = (class_weights.reshape(1, nc) * class_counts).sum(1)
+    # Produces image weights based on class mAPs, labels is a list of label arrays or a labels_to_class_counts() matrix
+    class_counts = labels if isinstance(labels, np.ndarray) else labels_to_class_counts(labels, nc)
+    image_weights = class_counts @ class_weights.reshape(nc)
     # index = random.choices(range(n), weights=image_weights, k=1)  # weight image sample
     return image_weights
 
@@ -835,6 +847,150 @@ def print_mutation(hyp, results, bucket=''):
         os.system('gsutil cp evolve.txt gs://%s' % bucket)  # upload evolve.txt
 
 
+def pipeline(source, stages, maxsize=4):
+    # Runs source (name, iterable) and stages [(name, fn)] each in its own thread, connected by bounded FIFO queues of
+    # maxsize items. fn(x) returns an iterable of items for the next stage, single threads and FIFO queues keep the
+    # item order. The last stage runs on the calling thread, i.e. for cv2.imshow() which needs the main thread on
+    # macOS. An exception in any stage stops all of them and is re-raised here, StopIteration ends quietly.
+    # Returns {name: [items in, seconds busy, summed input queue depth, max input queue depth]}
+    end = object()  # end of stream marker
+    stop = threading.Event()
+    errors = []
+    qs = [queue.Queue(maxsize) for _ in stages]
+    stats = {name: [0, 0., 0, 0] for name in [source[0]] + [name for name, _ in stages]}
+
+    def put(q, x):
+        while not stop.is_set():
+            try:
+                return q.put(x, timeout=0.1)
+            except queue.Full:
+                pass
+
+    def get(q):
+        while not stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return end
+
+    def run(i):
+        q_out = qs[i + 1] if i + 1 < len(qs) else None
+        try:
+            if i < 0:  # source
+                s, it = stats[source[0]], iter(source[1])
+                while not stop.is_set():
+                    t = time.time()
+                    x = next(it, end)
+                    if x is end:
+                        break
+                    s[0], s[1] = s[0] + 1, s[1] + time.time() - t
+                    put(q_out, x)
+            else:
+                (name, fn), q_in = stages[i], qs[i]
+                s = stats[name]
+                while True:
+                    depth = q_in.qsize()
+                    x = get(q_in)
+                    if x is end:
+                        break
+                    t = time.time()
+                    y = list(fn(x))
+                    s[0], s[1], s[2], s[3] = s[0] + 1, s[1] + time.time() - t, s[2] + depth, max(s[3], depth)
+                    if q_out is not None:
+                        for x in y:
+                            put(q_out, x)
+        except StopIteration:
+            stop.set()
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            if q_out is not None:
+                put(q_out, end)
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(-1, len(stages) - 1)]
+    for t in threads:
+        t.start()
+    run(len(stages) - 1)  # last stage on this thread
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return stats
+
+
+def print_pipeline_stats(stats):
+    # Prints items, mean latency and input queue depth (mean and max) per stage of a pipeline() run
+    print(('%12s' * 5) % ('Stage', 'Items', 'ms/item', 'Queue mean', 'Queue max'))
+    for name, (n, t, d, dmax) in stats.items():
+        print('%12s%12g%12.3g%12.3g%12g' % (name, n, 1E3 * t / max(n, 1), d / max(n, 1), dmax))
+
+
+class DetectionWriter:  # buffered detection output of a detect() run, flushed every flush rows
+    # Formats:
+    #   'txt'   one <image>.txt per image, a 'x1 y1 x2 y2 cls conf' line per detection (as before)
+    #   'jsonl' out/detections.jsonl, a {"frame", "path", "boxes", "conf", "cls"} line per image with detections
+    #   'bin'   out/detections.bin of detection_dtype records (see load_detections()), frame paths in detections.frames
+    # Frames are numbered by add() call, so video frames of one path stay distinguishable
+    formats = ('txt', 'jsonl', 'bin')
+    detection_dtype = np.dtype([('frame', '<u4'), ('box', '<f4', 4), ('conf', '<f4'), ('cls', '<u2')])
+
+    def __init__(self, out='output', format='txt', flush=1000):
+        assert format in self.formats, 'Unknown detection format %s, use one of %s' % (format, self.formats)
+        self.out, self.format, self.flush_rows = out, format, flush
+        self.frame = 0
+        self.rows = 0  # rows buffered
+        self.buffer = []  # (frame, path, n x 6 ndarray x1, y1, x2, y2, conf, cls) per image with detections
+        self.paths = []  # frame paths not yet written ('bin')
+
+    def add(self, path, det):
+        # Buffers the detections det (n x 6 tensor/ndarray, im0 pixels, or None) of frame path
+        if det is not None and len(det):
+            det = det.cpu().numpy() if isinstance(det, torch.Tensor) else np.asarray(det)
+            self.buffer.append((self.frame, path, det))
+            self.rows += len(det)
+        self.paths.append(path)
+        self.frame += 1
+        if self.rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if self.format == 'txt':
+            lines = {}
+            for _, path, det in self.buffer:
+                lines.setdefault(path, []).extend(('%g ' * 6 + '\n') % (*x[:4], x[5], x[4]) for x in det.tolist())
+            for path, x in lines.items():
+                with open(path + '.txt', 'a') as f:
+                    f.writelines(x)
+        elif self.format == 'jsonl':
+            with open(os.path.join(self.out, 'detections.jsonl'), 'a') as f:
+                f.writelines(json.dumps({'frame': i, 'path': path, 'boxes': det[:, :4].round(2).tolist(),
+                                         'conf': det[:, 4].round(4).tolist(), 'cls': det[:, 5].astype(int).tolist()})
+                             + '\n' for i, path, det in self.buffer)
+        else:
+            x = np.zeros(self.rows, dtype=self.detection_dtype)
+            if self.buffer:
+                x['frame'] = np.concatenate([np.full(len(det), i) for i, _, det in self.buffer])
+                det = np.concatenate([det for _, _, det in self.buffer])
+                x['box'], x['conf'], x['cls'] = det[:, :4], det[:, 4], det[:, 5]
+            with open(os.path.join(self.out, 'detections.bin'), 'ab') as f:
+                x.tofile(f)
+            with open(os.path.join(self.out, 'detections.frames'), 'a') as f:
+                f.writelines('%s\n' % p for p in self.paths)
+        self.buffer, self.rows, self.paths = [], 0, []
+
+    def close(self):
+        self.flush()
+
+
+def load_detections(path='output/detections.bin'):
+    # Returns the DetectionWriter 'bin' records and frame paths of a detect() run
+    with open(os.path.splitext(path)[0] + '.frames', 'r') as f:
+        paths = f.read().splitlines()
+    return np.fromfile(path, dtype=DetectionWriter.detection_dtype), paths
+
+
 def apply_classifier(x, model, img, im0):
     # applies a second stage classifier to yolo outputs
     im0 = [im0] if isinstance(im0, np.ndarray) else im0
@@ -926,7 +1082,8 @@ def plot_images(imgs, targets, paths=None, fname='images.jpg'):
         boxes = xywh2xyxy(targets[targets[:, 0] == i, 2:6]).T
         boxes[[0, 2]] *= w
         boxes[[1, 3]] *= h
-        plt.subplot(ns, ns, i + 1).imshow(imgs[i].transpose(1, 2, 0))
+        img = imgs[i].transpose(1, 2, 0)
+        plt.subplot(ns, ns, i + 1).imshow(img[:, :, 0] if img.shape[2] == 1 else img, cmap='gray')
         plt.plot(boxes[[0, 2, 2, 0, 0]], boxes[[1, 1, 3, 3, 1]], '.-')
         plt.axis('off')
         if paths is not None: